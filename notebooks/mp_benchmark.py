@@ -0,0 +1,337 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import resource
+import itertools
+import multiprocessing
+from queue import Empty
+import mp_instrument
+import mp_utils as mp
+
+# benchmarks for the feature extraction and scoring hot paths in mp_utils
+# data is synthetic, shaped like mp_data, so the benchmarks run without database access
+# each benchmark runs in a separate process, and the memory (RSS) used by the timed call is measured
+# the benchmarks can be swept over the number of stays, the length of stay, and the missingness, e.g.
+#   python mp_benchmark.py --stays 1000,10000 --los 24,72,168 --missing 0.2,0.8 --save benchmark_baseline.json
+#   python mp_benchmark.py --stays 1000,10000 --los 24,72,168 --missing 0.2,0.8 --baseline benchmark_baseline.json
+# the second call exits with a non-zero status if any benchmark is slower than the baseline by more than
+# the tolerance and the run to run variation, or uses more memory (see compare_to_baseline)
+
+# the fewest runs of each benchmark, of which the median time is used
+MIN_REPEAT = 5
+
+# differences in memory below this (MB) are not regressions
+RSS_FLOOR = 16.0
+
+
+def generate_mp_data(n_stays=1000, mean_los=72, missing=0.5, missing_lab=0.95, seed=0):
+    # creates synthetic data in the shape of mp_data, mp_static_data, and the death info in the notebooks
+    #   n_stays - number of icustay_id
+    #   mean_los - average length of stay in hours (exponentially distributed, minimum 4 hours)
+    #   missing - fraction of missing values for vitals/gcs/urine output
+    #   missing_lab - fraction of missing values for labs and blood gases
+    rng = np.random.default_rng(seed)
+    var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early, var_static = mp.vars_of_interest()
+
+    iid = 200000 + np.arange(n_stays)
+    los = np.maximum(np.ceil(rng.exponential(mean_los, n_stays)), 4).astype(int)
+
+    # one row per hour from 24 hours before admission to discharge, as in mp_hourly_cohort
+    n_rows = los + 25
+    df = pd.DataFrame({'subject_id': np.repeat(iid - 100000, n_rows),
+                       'hadm_id': np.repeat(iid - 50000, n_rows),
+                       'icustay_id': np.repeat(iid, n_rows),
+                       'hr': np.concatenate([np.arange(-24, l+1) for l in los])})
+
+    variables = list()
+    for var_agg in [var_min, var_max, var_first, var_last, var_sum]:
+        variables.extend([v for v in var_agg if v not in variables])
+    labs = [v for v in var_first_early if v not in variables]
+
+    N = df.shape[0]
+    for v in variables + labs:
+        x = rng.normal(50, 10, N)
+        x[rng.random(N) < (missing_lab if v in labs else missing)] = np.nan
+        df[v] = x
+
+    # death for ~10% of stays, around discharge
+    death = rng.random(n_stays) < 0.1
+    df_death = pd.DataFrame({'subject_id': iid - 100000, 'hadm_id': iid - 50000, 'icustay_id': iid,
+                             'dischtime_hours': los.astype(float),
+                             'deathtime_hours': np.where(death, los + rng.integers(-2, 24, n_stays), np.nan),
+                             'death': death.astype(int)})
+
+    df_static = pd.DataFrame({'icustay_id': iid})
+    for v in var_static:
+        df_static[v] = rng.normal(0, 1, n_stays)
+
+    return df, df_static, df_death
+
+
+class SimpleModel(object):
+    # stands in for a fitted model: a fixed logistic regression on the mean-imputed features
+    def __init__(self, n_features, seed=0):
+        self.coef = np.random.default_rng(seed).normal(0, 0.01, n_features)
+
+    def predict_proba(self, X):
+        X = np.nan_to_num(np.asarray(X, dtype=float))
+        p = 1.0 / (1.0 + np.exp(-np.dot(X, self.coef)))
+        return np.column_stack([1-p, p])
+
+
+def setup_generate_times(n_stays, mean_los, missing, path):
+    df, df_static, df_death = generate_mp_data(n_stays, mean_los=mean_los, missing=missing)
+    return [df_death], dict(T=2, seed=111)
+
+
+def setup_get_design_matrix(n_stays, mean_los, missing, path):
+    df, df_static, df_death = generate_mp_data(n_stays, mean_los=mean_los, missing=missing)
+    time_dict = mp.generate_times(df_death.copy(), T=2, seed=111)
+    return [df, time_dict], dict(W=8, W_extra=24)
+
+
+def setup_load_design_matrix(n_stays, mean_los, missing, path):
+    df, df_static, df_death = generate_mp_data(n_stays, mean_los=mean_los, missing=missing)
+    time_dict = mp.generate_times(df_death.copy(), T=2, seed=111)
+    df_design = mp.get_design_matrix(df, time_dict, W=8, W_extra=24)
+    df_design.to_csv(os.path.join(path, 'design_matrix_bench.csv'))
+
+    intime = pd.Timestamp('2100-01-01') + pd.to_timedelta(np.arange(n_stays), 'h')
+    df_offset = pd.DataFrame({'icustay_id': df_death['icustay_id'].values,
+                              'intime': intime,
+                              'outtime': intime + pd.to_timedelta(df_death['dischtime_hours'].values, 'h'),
+                              'starttime': np.zeros(n_stays),
+                              'deathtime': intime + pd.to_timedelta(df_death['deathtime_hours'].values, 'h')})
+    df_offset.to_csv(os.path.join(path, 'icustays_offset_bench.csv'), index=False)
+
+    co = df_death.set_index('icustay_id')[['death']]
+    return [co], dict(data_ext='bench', path=path + os.sep)
+
+
+def setup_get_predictions(n_stays, mean_los, missing, path):
+    df, df_static, df_death = generate_mp_data(n_stays, mean_los=mean_los, missing=missing)
+    # scores every hour of a single stay, so the stay closest to the mean length is used
+    iid = df_death['icustay_id'].values[np.argmin(np.abs(df_death['dischtime_hours'].values - mean_los))]
+    df = df.loc[df['icustay_id'] == iid, :]
+    n_features = mp.get_design_matrix(df, {iid: 0}, W=4, W_extra=24).shape[1] + len(mp.vars_of_interest()[7])
+    return [df, df_static, SimpleModel(n_features), iid], dict()
+
+
+def setup_collapse_data(n_stays, mean_los, missing, path):
+    # a dictionary of per-source frames, as collapse_data expects
+    df, df_static, df_death = generate_mp_data(n_stays, mean_los=mean_los, missing=missing)
+    df = df.rename(columns={'hr': 'charttime_elapsed'})
+    var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early, var_static = mp.vars_of_interest()
+    sources = {'vitals': var_first, 'labs': var_first_early, 'uo': var_sum}
+    data = dict()
+    for s in sources:
+        cols = [v for v in sources[s] if v in df.columns]
+        data[s] = df.loc[~df[cols].isnull().all(axis=1), ['subject_id', 'hadm_id', 'icustay_id', 'charttime_elapsed'] + cols].copy()
+    return [data], dict()
+
+
+benchmarks = {'generate_times': [mp.generate_times, setup_generate_times],
+              'get_design_matrix': [mp.get_design_matrix, setup_get_design_matrix],
+              'load_design_matrix': [mp.load_design_matrix, setup_load_design_matrix],
+              'get_predictions': [mp.get_predictions, setup_get_predictions],
+              'collapse_data': [mp.collapse_data, setup_collapse_data]}
+
+
+def reset_peak_rss():
+    # resets the peak resident memory of this process, so it can be measured for one call (linux only)
+    # returns False if it cannot be reset
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def get_peak_rss():
+    # peak resident memory of this process in MB, since the last reset_peak_rss on linux
+    try:
+        with open('/proc/self/status', 'r') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError, ValueError):
+        pass
+    # ru_maxrss is KB on linux, bytes on mac
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024.0 / 1024.0
+    return rss / 1024.0
+
+
+def run_one(name, n_stays, mean_los, missing, repeat, queue):
+    # runs in a child process: sets up the data, then times the function repeat times
+    # the memory used by the function is the peak RSS during the call less the RSS before it,
+    # so the memory used by the setup is not included (where the peak cannot be reset, e.g. on mac,
+    # it is how much the call raised the peak of the process, which is a lower bound)
+    fcn, setup = benchmarks[name]
+    path = tempfile.mkdtemp()
+    try:
+        args, kwargs = setup(n_stays, mean_los, missing, path)
+        rss_setup = get_peak_rss()
+        times = list()
+        rss_delta = list()
+        for r in range(repeat):
+            # some functions modify their inputs, so each repeat gets a copy
+            args_r = [x.copy() if hasattr(x, 'copy') else x for x in args]
+            reset_peak_rss()
+            rss0 = mp_instrument.get_rss()
+            t0 = time.time()
+            fcn(*args_r, **kwargs)
+            times.append(time.time() - t0)
+            rss_delta.append(max(get_peak_rss() - rss0, 0.0))
+            del args_r
+        queue.put({'time': float(np.median(times)), 'times': times,
+                   'rss_delta': float(np.median(rss_delta)), 'rss_setup': rss_setup})
+    except Exception as e:
+        queue.put({'error': '{}: {}'.format(type(e).__name__, e)})
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def get_result(p, queue, timeout):
+    # waits for the result of the child process p, which may crash (e.g. run out of memory)
+    # or hang rather than return one
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return queue.get(timeout=1.0)
+        except Empty:
+            pass
+        if p.exitcode is not None:
+            # the result may have arrived just before the process exited
+            try:
+                return queue.get(timeout=1.0)
+            except Empty:
+                return {'error': 'process exited with code {} without a result'.format(p.exitcode)}
+        if time.time() > deadline:
+            p.terminate()
+            return {'error': 'timed out after {} s'.format(timeout)}
+
+
+def get_spread(times):
+    # robust estimate of the standard deviation of the times (scaled median absolute deviation)
+    times = np.asarray(times, dtype=float)
+    return 1.4826 * float(np.median(np.abs(times - np.median(times))))
+
+
+def get_noise(res):
+    # standard error of the median time of a result (0 for results saved without the times)
+    if 'times' not in res or len(res['times']) < 2:
+        return 0.0
+    return 1.2533 * get_spread(res['times']) / np.sqrt(len(res['times']))
+
+
+def run_benchmarks(names=None, stays=(1000,), mean_los=(72,), missing=(0.5,), repeat=MIN_REPEAT,
+                   timeout=3600, verbose=True):
+    # runs each benchmark for every combination of stays, mean_los (hours), and missing (fraction of vitals)
+    # returns a dict of results keyed by "name/n_stays/mean_los/missing", with the median time
+    # of repeat runs (at least MIN_REPEAT) and the median memory used by the call
+    if names is None:
+        names = sorted(benchmarks.keys())
+    repeat = max(repeat, MIN_REPEAT)
+
+    results = dict()
+    for name in names:
+        for n_stays, los, miss in itertools.product(stays, mean_los, missing):
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=run_one, args=(name, n_stays, los, miss, repeat, queue))
+            p.start()
+            res = get_result(p, queue, timeout)
+            p.join()
+
+            key = '{}/{}/{}/{}'.format(name, n_stays, los, miss)
+            results[key] = res
+            if verbose:
+                if 'error' in res:
+                    print('{:45s} ERROR {}'.format(key, res['error']))
+                else:
+                    print('{:45s} {:8.3f} s (+/- {:6.3f}) {:8.1f} MB ({:8.1f} MB after setup)'.format(
+                        key, res['time'], get_spread(res['times']), res['rss_delta'], res['rss_setup']))
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=1.05, sigmas=3.0, rss_tolerance=1.25, verbose=True):
+    # returns the benchmarks which are slower or use more memory than the baseline
+    # a benchmark is slower if its median time is more than tolerance times the baseline's, and
+    # the difference is more than sigmas standard errors of the two medians, so noisy benchmarks
+    # are not flagged by chance
+    # it uses more memory if the memory used by the call is more than rss_tolerance times the baseline's,
+    # and by more than RSS_FLOOR MB (small allocations vary with the allocator)
+    regressions = list()
+    for key in sorted(results):
+        if key not in baseline or 'time' not in results[key] or 'time' not in baseline[key]:
+            continue
+        res, base = results[key], baseline[key]
+        ratio = res['time'] / max(base['time'], 1e-9)
+        noise = np.sqrt(get_noise(res)**2 + get_noise(base)**2)
+        slower = (ratio > tolerance) and (res['time'] - base['time'] > sigmas * noise)
+
+        rss_ratio = np.nan
+        larger = False
+        if 'rss_delta' in res and 'rss_delta' in base:
+            rss_ratio = res['rss_delta'] / max(base['rss_delta'], 1e-9)
+            larger = (rss_ratio > rss_tolerance) and (res['rss_delta'] - base['rss_delta'] > RSS_FLOOR)
+
+        if slower or larger:
+            regressions.append(key)
+        if verbose:
+            print('{:45s} {:6.2f}x time {:6.2f}x memory{}{}'.format(
+                key, ratio, rss_ratio, ' <-- SLOWER' if slower else '', ' <-- MORE MEMORY' if larger else ''))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the mp_utils hot paths on synthetic data.')
+    parser.add_argument('--benchmarks', default=None,
+                        help='comma separated list of: ' + ', '.join(sorted(benchmarks.keys())))
+    parser.add_argument('--stays', default='1000', help='comma separated list of the number of stays')
+    parser.add_argument('--los', default='72', help='comma separated list of the mean length of stay in hours')
+    parser.add_argument('--missing', default='0.5', help='comma separated list of the fraction of missing vital signs')
+    parser.add_argument('--repeat', type=int, default=MIN_REPEAT,
+                        help='number of repeats, at least {} (the median is reported)'.format(MIN_REPEAT))
+    parser.add_argument('--timeout', type=float, default=3600, help='seconds to wait for each benchmark')
+    parser.add_argument('--save', default=None, help='save the results as a baseline json file')
+    parser.add_argument('--baseline', default=None, help='compare the results to a baseline json file')
+    parser.add_argument('--tolerance', type=float, default=1.05, help='allowed slow down relative to the baseline')
+    parser.add_argument('--sigmas', type=float, default=3.0,
+                        help='standard errors a slow down must exceed to be a regression')
+    parser.add_argument('--rss-tolerance', type=float, default=1.25,
+                        help='allowed increase in memory relative to the baseline')
+    args = parser.parse_args(argv)
+
+    names = args.benchmarks.split(',') if args.benchmarks is not None else None
+    stays = [int(x) for x in args.stays.split(',')]
+    los = [float(x) for x in args.los.split(',')]
+    missing = [float(x) for x in args.missing.split(',')]
+    results = run_benchmarks(names=names, stays=stays, mean_los=los, missing=missing, repeat=args.repeat,
+                             timeout=args.timeout)
+
+    if args.save is not None:
+        with open(args.save, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as fp:
+            baseline = json.load(fp)
+        regressions = compare_to_baseline(results, baseline, tolerance=args.tolerance, sigmas=args.sigmas,
+                                          rss_tolerance=args.rss_tolerance)
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+# Import libraries
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import datetime as dt
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import mp_instrument
+
+# builds the tables created by the scripts in queries/ in dependency order
+# each script drops and creates one or more tables; the tables it reads are found from
+# its FROM/JOIN clauses, and a script depends on the scripts which create those tables
+# scripts whose dependencies are built run concurrently, each on its own pooled connection
+# a script is skipped if its sql, and the sql of everything upstream of it, is unchanged
+# since it was last built (and its tables still exist), e.g.
+#   python mp_build.py --queries ../queries --jobs 4
+#   python mp_build.py --queries ../queries --dry-run
+# tables from the database (e.g. chartevents, or ventdurations from mimic-code) are not tracked
+
+# the state of the last build is kept in this file: {script: signature}
+STATE_FILE = '.mp_build.json'
+
+
+def strip_sql(sql):
+    # removes comments and string literals, so they are not parsed as table references
+    sql = re.sub(r'/\*.*?\*/', ' ', sql, flags=re.DOTALL)
+    sql = re.sub(r'--[^\n]*', ' ', sql)
+    sql = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    return sql.lower()
+
+
+def parse_script(sql):
+    # returns the tables created by the script, and the tables it references
+    sql = strip_sql(sql)
+    ident = r'((?:[a-z_][a-z0-9_]*\.)?[a-z_][a-z0-9_]*)'
+    created = re.findall(r'create\s+(?:materialized\s+view|table)\s+(?:if\s+not\s+exists\s+)?' + ident, sql)
+    referenced = re.findall(r'(?:from|join)\s+' + ident, sql)
+
+    # schema names are dropped, as the scripts run with the mimic schema on the search path
+    created = list(OrderedDict.fromkeys([x.split('.')[-1] for x in created]))
+    referenced = set([x.split('.')[-1] for x in referenced])
+    return created, referenced
+
+
+def find_scripts(path):
+    # all .sql files under path, keyed by their path relative to it
+    scripts = OrderedDict()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            if f.endswith('.sql'):
+                fn = os.path.join(root, f)
+                scripts[os.path.relpath(fn, path)] = fn
+    return scripts
+
+
+class BuildGraph(object):
+    # the dependencies between the scripts in a directory
+    def __init__(self, path):
+        self.path = path
+        self.sql = OrderedDict()
+        self.tables = OrderedDict()
+        self.references = OrderedDict()
+        for name, fn in find_scripts(path).items():
+            with open(fn, 'r') as fp:
+                self.sql[name] = fp.read()
+            self.tables[name], self.references[name] = parse_script(self.sql[name])
+
+        # the script which creates each table
+        self.creator = dict()
+        for name in self.tables:
+            for t in self.tables[name]:
+                if t in self.creator:
+                    raise ValueError('{} is created by both {} and {}.'.format(t, self.creator[t], name))
+                self.creator[t] = name
+
+        self.depends = OrderedDict()
+        for name in self.tables:
+            self.depends[name] = sorted(set([self.creator[t] for t in self.references[name]
+                                             if t in self.creator and self.creator[t] != name]))
+
+        self.order = self.get_order()
+        self.signature = self.get_signatures()
+
+    def get_order(self):
+        # topological order of the scripts, keeping the file order where there is a choice
+        order = list()
+        done = set()
+        visiting = set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError('Circular dependency involving {}.'.format(name))
+            visiting.add(name)
+            for d in self.depends[name]:
+                visit(d)
+            visiting.remove(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.tables:
+            visit(name)
+        return order
+
+    def get_signatures(self):
+        # a hash of the script and the signatures of the scripts it depends on,
+        # so a change to a script changes the signature of everything downstream of it
+        signature = dict()
+        for name in self.order:
+            h = hashlib.sha1(self.sql[name].encode('utf-8'))
+            for d in self.depends[name]:
+                h.update(signature[d].encode('utf-8'))
+            signature[name] = h.hexdigest()
+        return signature
+
+    def downstream(self, names):
+        # the given scripts and all scripts which depend on them
+        names = set(names)
+        for name in self.order:
+            if any(d in names for d in self.depends[name]):
+                names.add(name)
+        return names
+
+
+def load_state(filename):
+    if filename is None or not os.path.exists(filename):
+        return dict()
+    with open(filename, 'r') as fp:
+        return json.load(fp)
+
+
+def save_state(filename, state):
+    if filename is None:
+        return
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(state, fp, indent=2, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+def tables_exist(session, tables):
+    with session.connection() as con:
+        cur = con.cursor()
+        cur.execute('select count(*) from pg_class c where c.relname = ANY(%(t)s) and pg_table_is_visible(c.oid)',
+                    {'t': list(tables)})
+        n = cur.fetchone()[0]
+        cur.close()
+    return n == len(tables)
+
+
+def run_script(session, name, sql):
+    # runs a script in one transaction on a pooled connection
+    t0 = time.time()
+    with mp_instrument.timer('mp_build.' + name):
+        with session.connection() as con:
+            cur = con.cursor()
+            cur.execute(sql)
+            cur.close()
+            con.commit()
+    return time.time() - t0
+
+
+def build(graph, session=None, jobs=4, state_file=STATE_FILE, targets=None, force=False,
+          dry_run=False, verbose=True):
+    # builds the scripts in the graph (or only the targets and what they depend on)
+    # returns a dataframe-ready list of dicts with the script, tables, status and time of each script
+    #   status is one of: built, skipped (unchanged), failed, blocked (an upstream script failed),
+    #   or pending (dry run)
+    state = load_state(state_file)
+
+    names = list(graph.order)
+    if targets is not None:
+        # targets can be script names or table names
+        targets = [graph.creator.get(t, t) for t in targets]
+        needed = set()
+        def add(name):
+            if name not in needed:
+                needed.add(name)
+                for d in graph.depends[name]:
+                    add(d)
+        for t in targets:
+            if t not in graph.depends:
+                raise ValueError('Unknown script or table: {}'.format(t))
+            add(t)
+        names = [n for n in names if n in needed]
+
+    # scripts which are unchanged since the last build are skipped
+    stale = set()
+    for name in names:
+        if force or state.get(name) != graph.signature[name]:
+            stale.add(name)
+        elif not dry_run and session is not None and not tables_exist(session, graph.tables[name]):
+            stale.add(name)
+    stale = graph.downstream(stale) & set(names)
+
+    report = OrderedDict([[name, {'script': name, 'tables': ', '.join(graph.tables[name]),
+                                  'status': 'skipped' if name not in stale else 'pending',
+                                  'time': 0.0}] for name in names])
+    if dry_run:
+        if verbose:
+            print_report(list(report.values()))
+        return list(report.values())
+
+    # run the stale scripts as their dependencies complete
+    remaining = dict([[name, set(d for d in graph.depends[name] if d in stale)] for name in names if name in stale])
+    running = dict()
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(remaining) > 0 or len(running) > 0:
+            ready = [name for name in names if name in remaining and len(remaining[name]) == 0]
+            for name in ready:
+                del remaining[name]
+                if verbose:
+                    print('{} - {:40s} started.'.format(dt.datetime.now(), name))
+                running[executor.submit(run_script, session, name, graph.sql[name])] = name
+
+            if len(running) == 0:
+                break
+            done, not_done = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+            for task in done:
+                name = running.pop(task)
+                try:
+                    report[name]['time'] = task.result()
+                    report[name]['status'] = 'built'
+                    state[name] = graph.signature[name]
+                    save_state(state_file, state)
+                    for n in remaining:
+                        remaining[n].discard(name)
+                except Exception as e:
+                    report[name]['status'] = 'failed'
+                    report[name]['error'] = str(e).strip()
+                    state.pop(name, None)
+                    save_state(state_file, state)
+                    # everything downstream of a failure is not run
+                    for n in graph.downstream([name]):
+                        if n in remaining:
+                            del remaining[n]
+                            report[n]['status'] = 'blocked'
+                if verbose:
+                    print('{} - {:40s} {} ({:0.1f}s).'.format(dt.datetime.now(), name,
+                                                              report[name]['status'], report[name]['time']))
+                    if 'error' in report[name]:
+                        print(report[name]['error'])
+
+    if verbose:
+        print_report(list(report.values()))
+        print('Total time {:0.1f}s.'.format(time.time() - t0))
+    return list(report.values())
+
+
+def print_report(report):
+    print('{:40s} {:8s} {:>8s}  {}'.format('script', 'status', 'time (s)', 'tables'))
+    for r in report:
+        print('{:40s} {:8s} {:8.1f}  {}'.format(r['script'], r['status'], r['time'], r['tables']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the tables from the sql scripts in dependency order.')
+    parser.add_argument('--queries', default=os.path.join('..', 'queries'), help='directory of sql scripts')
+    parser.add_argument('--sqluser', default='alistairewj')
+    parser.add_argument('--dbname', default='mimic')
+    parser.add_argument('--schema', default='mimiciii', help='schema of the mimic tables, searched after public')
+    parser.add_argument('--jobs', type=int, default=4, help='number of scripts run at once')
+    parser.add_argument('--state', default=STATE_FILE, help='file with the signatures of the last build')
+    parser.add_argument('--force', action='store_true', help='rebuild all scripts')
+    parser.add_argument('--dry-run', action='store_true', help='print what would be built')
+    parser.add_argument('targets', nargs='*', help='scripts or tables to build (default: all)')
+    args = parser.parse_args(argv)
+
+    graph = BuildGraph(args.queries)
+    session = None
+    if not args.dry_run:
+        import mp_queries
+        # the tables are created in public, with the mimic tables on the search path (as in mp_load)
+        session = mp_queries.Session(sqluser=args.sqluser, dbname=args.dbname, schema_name='public,' + args.schema,
+                                     minconn=1, maxconn=args.jobs + 1)
+    try:
+        report = build(graph, session=session, jobs=args.jobs, state_file=args.state,
+                       targets=args.targets if len(args.targets) > 0 else None,
+                       force=args.force, dry_run=args.dry_run)
+    finally:
+        if session is not None:
+            session.close()
+    return 1 if any(r['status'] in ('failed', 'blocked') for r in report) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,374 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+import os
+import json
+import shutil
+import hashlib
+import pickle
+import weakref
+from collections import OrderedDict
+
+# columnar on-disk cache for the extracted tables
+# the first time a table is read (from csv or sql) each column is written as a .npy file,
+# later reads memory-map the numeric columns rather than re-parsing the csv
+# a cache entry is keyed by:
+#   csv: the file path, size, and modification time
+#   sql: the query text and the contents of the sql scripts which create the view
+# plus any extra key (e.g. the data_ext used in load_design_matrix)
+# when the key changes, the old entry for that table is removed
+# csv entries are named by the file name and a hash of its absolute path, so files of the same
+# name in different directories (e.g. two data_path) have separate entries
+#
+# computed frames (e.g. design matrices) are kept by FrameCache, keyed by a hash of their inputs,
+# in memory and on disk with least recently used entries evicted beyond a size limit
+
+CACHE_DIR = '.mp_cache'
+
+# default size limits of a FrameCache, in bytes
+MEMORY_LIMIT = 512 * 2**20
+DISK_LIMIT = 8 * 2**30
+
+
+def hash_key(items):
+    # creates a short hash of a list of strings
+    h = hashlib.sha1()
+    for x in items:
+        h.update(str(x).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()[0:16]
+
+
+def file_signature(filename, content=False):
+    # returns a string which changes when the file changes
+    # by default this is the size and modification time, which avoids reading the file
+    # content=True hashes the file instead (used for small files like sql scripts)
+    if content:
+        with open(filename, 'rb') as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+    st = os.stat(filename)
+    return '{}:{}:{}'.format(os.path.abspath(filename), st.st_size, st.st_mtime)
+
+
+def get_entry_path(name, key, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    return os.path.join(cache_dir, name + '-' + key)
+
+
+def clear_entries(name, cache_dir=None, keep=None):
+    # removes all cached entries for a table, except the one in keep
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        return
+    for f in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, f)
+        if f.rsplit('-', 1)[0] == name and path != keep and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def write_frame(df, path):
+    # writes each column of df to its own .npy file, along with a metadata file
+    # numeric and datetime columns are memory-mappable; other columns are pickled
+    tmp_path = path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    meta = {'columns': list(), 'index_name': df.index.name}
+    for i, c in enumerate(df.columns):
+        x = df[c].values
+        if x.dtype.kind in ('i', 'u', 'f', 'b'):
+            kind = 'npy'
+            np.save(os.path.join(tmp_path, 'col{}.npy'.format(i)), x)
+        elif x.dtype.kind == 'M':
+            kind = 'datetime'
+            np.save(os.path.join(tmp_path, 'col{}.npy'.format(i)), x.astype('datetime64[ns]').view(np.int64))
+        else:
+            kind = 'pickle'
+            with open(os.path.join(tmp_path, 'col{}.pkl'.format(i)), 'wb') as fp:
+                pickle.dump(x, fp, protocol=2)
+        meta['columns'].append([str(c), kind])
+
+    # the index is only kept if it is not the default range index
+    if not isinstance(df.index, pd.RangeIndex):
+        np.save(os.path.join(tmp_path, 'index.npy'), np.asarray(df.index.values))
+        meta['index'] = True
+
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as fp:
+        json.dump(meta, fp)
+
+    # rename at the end so a partially written entry is never read
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def read_frame(path, mmap=True):
+    # reads a frame written by write_frame
+    # with mmap=True the numeric columns are read-only memory maps of the files
+    with open(os.path.join(path, 'meta.json'), 'r') as fp:
+        meta = json.load(fp)
+
+    mmap_mode = 'r' if mmap else None
+    data = dict()
+    for i, (c, kind) in enumerate(meta['columns']):
+        if kind == 'npy':
+            data[c] = np.load(os.path.join(path, 'col{}.npy'.format(i)), mmap_mode=mmap_mode)
+        elif kind == 'datetime':
+            data[c] = np.load(os.path.join(path, 'col{}.npy'.format(i))).view('datetime64[ns]')
+        else:
+            with open(os.path.join(path, 'col{}.pkl'.format(i)), 'rb') as fp:
+                data[c] = pickle.load(fp)
+
+    index = None
+    if meta.get('index', False):
+        index = pd.Index(np.load(os.path.join(path, 'index.npy'), allow_pickle=True),
+                         name=meta['index_name'])
+
+    columns = [c for c, kind in meta['columns']]
+    df = pd.DataFrame(data, columns=columns, index=index, copy=False)
+    return df
+
+
+def cached(name, key, fcn, cache_dir=None, mmap=True):
+    # returns the cached table name/key if present, otherwise calls fcn() and caches the result
+    path = get_entry_path(name, key, cache_dir=cache_dir)
+    if os.path.isfile(os.path.join(path, 'meta.json')):
+        return read_frame(path, mmap=mmap)
+
+    df = fcn()
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    clear_entries(name, cache_dir=cache_dir, keep=path)
+    write_frame(df, path)
+
+    if mmap:
+        return read_frame(path, mmap=mmap)
+    return df
+
+
+def get_csv_entry_name(filename):
+    # the entry name of a csv file, e.g. design_matrix_1a2b3c4d for .../design_matrix.csv
+    base = os.path.splitext(os.path.basename(filename))[0]
+    return base + '_' + hash_key([os.path.abspath(filename)])[0:8]
+
+
+def read_csv_cached(filename, parse_dates=None, key='', cache_dir=None, mmap=True, **kwargs):
+    # drop-in replacement for pd.read_csv, caching the parsed result
+    # parse_dates columns are converted with pd.to_datetime before caching
+    # key is any additional string which should invalidate the cache (e.g. data_ext)
+    name = get_csv_entry_name(filename)
+    entry_key = hash_key([file_signature(filename), key, parse_dates, sorted(kwargs.items())])
+
+    def fcn():
+        df = pd.read_csv(filename, **kwargs)
+        if parse_dates is not None:
+            for c in parse_dates:
+                df[c] = pd.to_datetime(df[c])
+        return df
+
+    return cached(name, entry_key, fcn, cache_dir=cache_dir, mmap=mmap)
+
+
+def read_sql_cached(query, con, name, source_files=None, key='', cache_dir=None, mmap=True):
+    # cached version of pd.read_sql_query
+    # source_files are the sql scripts which create the tables used by the query,
+    # e.g. ['../queries/data.sql'], so re-running a changed script invalidates the entry
+    if source_files is None:
+        source_files = list()
+    entry_key = hash_key([query, key] + [file_signature(f, content=True) for f in source_files])
+
+    def fcn():
+        return pd.read_sql_query(query, con)
+
+    return cached(name, entry_key, fcn, cache_dir=cache_dir, mmap=mmap)
+
+
+def update_hash(h, x):
+    # adds the content of x to the hash h: arrays by their bytes, frames by their columns and index,
+    # containers by their items, and other objects (e.g. mp_sparse.SparseHourlyData) by their attributes
+    if isinstance(x, pd.DataFrame):
+        update_hash(h, [str(c) for c in x.columns])
+        update_hash(h, np.asarray(x.index.values))
+        for i in range(x.shape[1]):
+            update_hash(h, np.asarray(x.iloc[:, i].values))
+    elif isinstance(x, pd.Series):
+        update_hash(h, str(x.name))
+        update_hash(h, np.asarray(x.index.values))
+        update_hash(h, np.asarray(x.values))
+    elif isinstance(x, np.ndarray):
+        h.update('{}{}'.format(x.dtype.str, x.shape).encode('utf-8'))
+        if x.dtype.kind == 'O':
+            h.update(pickle.dumps(x.tolist(), protocol=2))
+        elif x.dtype.kind in ('M', 'm'):
+            h.update(np.ascontiguousarray(x).view(np.int64))
+        else:
+            h.update(np.ascontiguousarray(x))
+    elif isinstance(x, dict):
+        h.update(b'{')
+        for k in sorted(x.keys(), key=str):
+            update_hash(h, k)
+            update_hash(h, x[k])
+        h.update(b'}')
+    elif isinstance(x, (list, tuple)):
+        h.update(b'[')
+        for item in x:
+            update_hash(h, item)
+        h.update(b']')
+    elif hasattr(x, '__dict__') and not isinstance(x, type):
+        update_hash(h, type(x).__name__)
+        update_hash(h, vars(x))
+    else:
+        h.update(repr(x).encode('utf-8'))
+        h.update(b'\0')
+
+
+def hash_content(x):
+    h = hashlib.sha1()
+    update_hash(h, x)
+    return h.hexdigest()
+
+
+# memoised versions of objects, by id: [weak reference, fingerprint, version]
+_versions = dict()
+
+
+def fingerprint(x):
+    # a cheap summary of a frame, to check the memoised version is still valid
+    # changes to the shape, columns, or ~1000 evenly spaced rows are detected
+    if isinstance(x, pd.DataFrame):
+        idx = np.unique(np.linspace(0, x.shape[0]-1, min(x.shape[0], 1024)).astype(int))
+        return [x.shape, hash_content(x.iloc[idx, :])]
+    return None
+
+
+def data_version(x):
+    # a hash of the content of x (e.g. mp_data, or an mp_sparse.SparseHourlyData),
+    # memoised for as long as the object exists so repeated calls do not hash it again
+    # a frame changed in place in rows outside the fingerprint is not detected - in that case,
+    # identify the data explicitly instead (e.g. by the data_ext and path of its source files)
+    fp = fingerprint(x)
+    entry = _versions.get(id(x))
+    if entry is not None and entry[0]() is x and entry[1] == fp:
+        return entry[2]
+
+    version = hash_content(x)
+    key = id(x)
+
+    def forget(ref):
+        if key in _versions and _versions[key][0] is ref:
+            del _versions[key]
+
+    try:
+        _versions[key] = [weakref.ref(x, forget), fp, version]
+    except TypeError:
+        # objects which cannot be weakly referenced are not memoised
+        pass
+    return version
+
+
+class FrameCache(object):
+    # least recently used cache of data frames, in memory and on disk
+    #   name - prefix of the entries in cache_dir
+    #   memory_limit - bytes of frames kept in memory
+    #   disk_limit - bytes of entries kept in cache_dir (0 to keep entries in memory only)
+    # frames are copied on the way in and out, so changing a returned frame does not change the cache
+    def __init__(self, name, cache_dir=None, memory_limit=MEMORY_LIMIT, disk_limit=DISK_LIMIT):
+        self.name = name
+        self.cache_dir = CACHE_DIR if cache_dir is None else cache_dir
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+
+    def get(self, key):
+        # returns the cached frame, or None if there is no entry for key
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits['memory'] += 1
+            return self.memory[key][0].copy()
+
+        path = get_entry_path(self.name, key, cache_dir=self.cache_dir)
+        meta = os.path.join(path, 'meta.json')
+        if os.path.isfile(meta):
+            df = read_frame(path, mmap=False)
+            # the modification time orders entries for eviction
+            os.utime(meta, None)
+            self.hits['disk'] += 1
+            self.put_memory(key, df)
+            return df.copy()
+
+        self.misses += 1
+        return None
+
+    def put(self, key, df):
+        self.put_memory(key, df.copy())
+        self.put_disk(key, df)
+
+    def put_memory(self, key, df):
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        if key in self.memory:
+            self.memory_size -= self.memory.pop(key)[1]
+        if size > self.memory_limit:
+            return
+        self.memory[key] = [df, size]
+        self.memory_size += size
+        while self.memory_size > self.memory_limit:
+            k, (df_old, size_old) = self.memory.popitem(last=False)
+            self.memory_size -= size_old
+
+    def put_disk(self, key, df):
+        if self.disk_limit <= 0:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = get_entry_path(self.name, key, cache_dir=self.cache_dir)
+        write_frame(df, path)
+        self.evict_disk(keep=path)
+
+    def get_disk_entries(self):
+        # [last used, size, path] of each entry on disk, least recently used first
+        entries = list()
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for f in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, f)
+            meta = os.path.join(path, 'meta.json')
+            if f.rsplit('-', 1)[0] != self.name or not os.path.isfile(meta):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, g)) for g in os.listdir(path))
+            entries.append([os.path.getmtime(meta), size, path])
+        return sorted(entries)
+
+    def evict_disk(self, keep=None):
+        # removes the least recently used entries until the entries fit in disk_limit
+        # an entry larger than disk_limit on its own is removed too, including keep
+        entries = self.get_disk_entries()
+        total = sum(e[1] for e in entries)
+        for t, size, path in entries:
+            if total <= self.disk_limit:
+                break
+            if path == keep and size <= self.disk_limit:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def fetch(self, key, fcn):
+        # returns the cached frame for key, or calls fcn() and caches the result
+        df = self.get(key)
+        if df is None:
+            df = fcn()
+            self.put(key, df)
+        return df
+
+    def clear(self, disk=True):
+        self.memory.clear()
+        self.memory_size = 0
+        if disk:
+            clear_entries(self.name, cache_dir=self.cache_dir)
@@ -0,0 +1,171 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+import mp_instrument
+import mp_window
+
+# precomputed per-stay aggregates of the hourly data (mp_data)
+# the index is built once, after which a window aggregate is a few array lookups
+# rather than a gather of the rows in the window:
+#   first/last - pointers to the next/previous observed row
+#   min/max - sparse tables of the min/max over 2^k rows
+#   sum - cumulative sum within each stay
+# it can be used in place of the data frame in mp_utils.get_design_matrix, e.g.
+#   idx = WindowIndex(df)
+#   for W in [4, 8, 12, 24]:
+#       df_data = mp.get_design_matrix(idx, time_dict, W=W, W_extra=24)
+# results are identical to using df, except sums, which may differ by floating point rounding
+
+
+class WindowIndex(object):
+    def __init__(self, df, var_list=None, max_window=64):
+        # max_window is the number of rows covered by a single sparse table lookup
+        # longer windows take more lookups; the tables use ~log2(max_window) times the memory of the data
+        if var_list is None:
+            var_list = mp_window.vars_of_interest()
+        self.var_list = var_list
+        var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early = var_list[0:7]
+
+        with mp_instrument.timer('WindowIndex.build', rows=df.shape[0]):
+            df = mp_window.sort_data(df)
+            self.stay_iid, self.offset = mp_window.get_stay_offsets(df['icustay_id'].values)
+            self.hr = np.asarray(df['hr'].values, dtype=int)
+            self.key = None
+            if self.hr.shape[0] > 0:
+                self.key = mp_window.get_window_key(self.stay_iid, self.offset, self.hr)
+            self.N = self.hr.shape[0]
+            self.levels = max(int(np.floor(np.log2(max(max_window, 1)))), 0)
+
+            self.x = dict()
+            self.first = dict()
+            self.last = dict()
+            self.min = dict()
+            self.max = dict()
+            self.sum = dict()
+            for var_agg, agg in [[var_first, 'first'], [var_first_early, 'first'],
+                                 [var_last, 'last'], [var_last_early, 'last'],
+                                 [var_min, 'min'], [var_max, 'max'], [var_sum, 'sum']]:
+                if var_agg is None:
+                    continue
+                for v in var_agg:
+                    if v not in self.x:
+                        self.x[v] = np.asarray(df[v].values, dtype=float)
+                    self.build(v, agg)
+
+    def build(self, v, agg):
+        x = self.x[v]
+        N = self.N
+        if agg == 'first' and v not in self.first:
+            # first[r] is the first observed row >= r (N if none)
+            obs = np.nonzero(~np.isnan(x))[0]
+            nxt = np.append(obs, N)
+            self.first[v] = nxt[np.searchsorted(obs, np.arange(N+1), side='left')]
+        elif agg == 'last' and v not in self.last:
+            # last[r] is the last observed row < r (-1 if none)
+            obs = np.nonzero(~np.isnan(x))[0]
+            prv = np.concatenate([[-1], obs])
+            self.last[v] = prv[np.searchsorted(obs, np.arange(N+1), side='left')]
+        elif agg in ('min', 'max') and v not in getattr(self, agg):
+            # table[k][r] is the aggregate of rows [r, r + 2^k), ignoring missing values
+            # rows past the end of the data only include the rows which exist
+            fcn = np.fmin if agg == 'min' else np.fmax
+            table = [x]
+            for k in range(1, self.levels+1):
+                prev = table[-1]
+                h = 2**(k-1)
+                curr = prev.copy()
+                if h < N:
+                    curr[:N-h] = fcn(prev[:N-h], prev[h:])
+                table.append(curr)
+            getattr(self, agg)[v] = table
+        elif agg == 'sum' and v not in self.sum:
+            # cumulative sum of the rows up to and including r, restarting at each stay
+            csum = np.cumsum(np.nan_to_num(x))
+            stay_total = np.concatenate([[0], csum[self.offset[1:-1] - 1]]) if N > 0 else np.zeros(0)
+            self.sum[v] = csum - np.repeat(stay_total, np.diff(self.offset))
+
+    def get_window_rows(self, iid, t_start, t_end):
+        if self.N == 0:
+            return np.zeros(len(iid), dtype=int), np.zeros(len(iid), dtype=int)
+        return mp_window.get_window_rows(self.stay_iid, self.offset, self.hr, iid, t_start, t_end, key=self.key)
+
+    def aggregate(self, v, agg, a, b):
+        # aggregate of variable v over the rows [a, b) of each window
+        x = self.x[v]
+        y = np.full(a.shape[0], np.nan)
+        if agg == 'first':
+            r = self.first[v][a]
+            idx = r < b
+            y[idx] = x[r[idx]]
+        elif agg == 'last':
+            r = self.last[v][b]
+            idx = r >= a
+            y[idx] = x[r[idx]]
+        elif agg in ('min', 'max'):
+            fcn = np.fmin if agg == 'min' else np.fmax
+            table = getattr(self, agg)[v]
+            L = b - a
+            # the largest power of two no longer than the window, up to the number of levels
+            k = np.zeros(L.shape[0], dtype=int)
+            k[L > 0] = np.minimum(np.floor(np.log2(L[L > 0])).astype(int), self.levels)
+            step = 2**k
+
+            # two overlapping lookups cover windows up to 2^(k+1) rows
+            # longer windows are covered by more lookups, 2^levels rows at a time
+            idx = L > 0
+            start = a.copy()
+            while np.any(idx):
+                for j in np.unique(k[idx]):
+                    idx_j = idx & (k == j)
+                    y[idx_j] = fcn(y[idx_j], table[j][start[idx_j]])
+                start[idx] = start[idx] + step[idx]
+                idx = idx & (start + step < b)
+            idx = L > 0
+            for j in np.unique(k[idx]):
+                idx_j = idx & (k == j)
+                y[idx_j] = fcn(y[idx_j], table[j][b[idx_j] - step[idx_j]])
+        elif agg == 'sum':
+            csum = self.sum[v]
+            idx = b > a
+            stay_start = self.offset[np.searchsorted(self.offset, a[idx], side='right') - 1]
+            y[idx] = csum[b[idx]-1] - np.where(a[idx] > stay_start, csum[np.maximum(a[idx]-1, 0)], 0)
+        else:
+            raise ValueError('Unrecognized aggregate: {}'.format(agg))
+        return y
+
+    def get_window_features(self, iid, t, W=8, W_extra=24, var_list=None):
+        # the same as mp_utils.get_window_features for the indexed data
+        if var_list is None:
+            var_list = self.var_list
+        var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early = var_list[0:7]
+
+        iid = np.asarray(iid).astype(int)
+        t = np.asarray(t).astype(int)
+
+        with mp_instrument.timer('WindowIndex.window_rows', windows=iid.shape[0]):
+            a, b = self.get_window_rows(iid, t-W, t)
+            a_early, b_early = self.get_window_rows(iid, t-W-W_extra, t)
+
+        features = [[var_first, 'first', False], [var_first_early, 'first', True],
+                    [var_last, 'last', False], [var_last_early, 'last', True],
+                    [var_min, 'min', False], [var_max, 'max', False],
+                    [var_sum, 'sum', False]]
+
+        data = OrderedDict()
+        for var_agg, agg, early in features:
+            if var_agg is None:
+                continue
+            with mp_instrument.timer('WindowIndex.' + agg + ('_early' if early else ''), variables=len(var_agg)):
+                for v in var_agg:
+                    if v not in getattr(self, agg):
+                        raise ValueError('{} is not indexed for {}.'.format(v, agg))
+                    if early:
+                        x = self.aggregate(v, agg, a_early, b_early)
+                    else:
+                        x = self.aggregate(v, agg, a, b)
+                    data[v + '_' + agg + ('_early' if early else '')] = x
+
+        # sums over windows without any rows are already missing
+        df_data = pd.DataFrame(data, columns=list(data.keys()))
+        return df_data, b_early > a_early
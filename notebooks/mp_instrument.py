@@ -0,0 +1,138 @@
+# Import libraries
+import os
+import sys
+import json
+import time
+import logging
+import resource
+from contextlib import contextmanager
+
+# opt-in timers and counters for the stages of the extraction/query functions
+# nothing is recorded unless a sink is added, e.g.
+#   import mp_instrument
+#   collector = mp_instrument.MemorySink()
+#   mp_instrument.add_sink(collector)
+#   df_data = mp.get_design_matrix(df, time_dict)
+#   collector.to_frame()
+# each record is a dict with:
+#   stage - the name of the stage, e.g. 'get_design_matrix.sort'
+#   time - wall time in seconds (timers only)
+#   rss_delta - change in resident memory in MB over the stage (timers only)
+#   plus any counts added by the caller, e.g. rows, bytes, windows
+
+# the active sinks - records are passed to each of these
+sinks = list()
+
+
+def add_sink(sink):
+    # a sink is any callable which accepts a record (dict)
+    sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    if sink in sinks:
+        sinks.remove(sink)
+
+
+def clear_sinks():
+    del sinks[:]
+
+
+def enabled():
+    return len(sinks) > 0
+
+
+class LoggingSink(object):
+    # writes each record to a logger as a json string
+    def __init__(self, logger=None, level=logging.INFO):
+        if logger is None:
+            logger = logging.getLogger('mp_instrument')
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, record):
+        self.logger.log(self.level, to_json(record))
+
+
+class JsonLinesSink(object):
+    # appends each record to a file, one json object per line
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __call__(self, record):
+        with open(self.filename, 'a') as fp:
+            fp.write(to_json(record) + '\n')
+
+
+class MemorySink(object):
+    # keeps all records in a list
+    def __init__(self):
+        self.records = list()
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def clear(self):
+        self.records = list()
+
+    def to_frame(self):
+        import pandas as pd
+        return pd.DataFrame(self.records)
+
+
+def get_rss():
+    # current resident memory of this process in MB
+    # /proc is only on linux; elsewhere the peak memory is used as an approximation
+    try:
+        with open('/proc/self/statm', 'r') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+    except (IOError, OSError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return rss / 1024.0 / 1024.0
+        return rss / 1024.0
+
+
+def to_json(record):
+    # numpy scalars are converted to python numbers
+    return json.dumps(record, sort_keys=True,
+                      default=lambda x: x.item() if hasattr(x, 'item') else str(x))
+
+
+def emit(record):
+    for sink in sinks:
+        sink(record)
+
+
+def count(stage, **counts):
+    # records counts without timing, e.g. count('mp_queries.charts', rows=100)
+    if not sinks:
+        return
+    record = {'stage': stage, 'timestamp': time.time()}
+    record.update(counts)
+    emit(record)
+
+
+@contextmanager
+def timer(stage, **counts):
+    # times the enclosed block, e.g.
+    #   with timer('load_design_matrix.read', bytes=nbytes) as rec:
+    #       df = pd.read_csv(...)
+    #       rec['rows'] = df.shape[0]
+    # counts can be passed in, or added to the yielded dict during the block
+    record = dict(counts)
+    if not sinks:
+        yield record
+        return
+
+    rss0 = get_rss()
+    t0 = time.time()
+    try:
+        yield record
+    finally:
+        record['time'] = time.time() - t0
+        record['rss_delta'] = get_rss() - rss0
+        record['stage'] = stage
+        record['timestamp'] = t0
+        emit(record)
@@ -0,0 +1,121 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+
+# interval index for the range signal tables (vent, vasopressor, rrt_range)
+# each table has one row per range: icustay_id, starttime_elapsed, endtime_elapsed
+# the ranges of a stay are merged into sorted, non-overlapping intervals, and a
+# batch of windows is answered with a few vectorised binary searches, e.g.
+#   vent = StayIntervals(df_vent)
+#   df_vent_features = vent.get_features(iid, t, W=8, name='vent')
+# for each window [t-W, t] this gives:
+#   vent_any - 1 if any range overlaps the window
+#   vent_all - 1 if the ranges cover the entire window
+#   vent_hours - the number of hours in the window covered by a range
+
+# the column name used for each range table, as in mp_utils.collapse_data
+range_names = {'vent': 'vent',
+               'vasopressor': 'vasopressor',
+               'rrt_range': 'rrt'}
+
+
+def searchsorted_grouped(g, x, gq, xq, side='left'):
+    # np.searchsorted for an array sorted by (group, value)
+    #   g, x - the group and value of each element, sorted by (g, x)
+    #   gq, xq - the group and value of each query
+    # returns the index at which each query would be inserted to keep the order
+    # queries and elements are sorted together, so ties are resolved exactly
+    n = x.shape[0]
+    m = xq.shape[0]
+    if m == 0:
+        return np.zeros(0, dtype=int)
+    if side == 'left':
+        # queries go before elements with equal values
+        kind = np.concatenate([np.ones(n, dtype=np.int8), np.zeros(m, dtype=np.int8)])
+    else:
+        kind = np.concatenate([np.zeros(n, dtype=np.int8), np.ones(m, dtype=np.int8)])
+
+    order = np.lexsort((kind, np.concatenate([x, xq]), np.concatenate([g, gq])))
+    is_elem = order < n
+    # number of elements before each position in the combined order
+    cnt = np.cumsum(is_elem) - is_elem
+
+    idx = np.zeros(m, dtype=int)
+    idx[order[~is_elem] - n] = cnt[~is_elem]
+    return idx
+
+
+class StayIntervals(object):
+    # sorted, merged intervals for each icustay_id, in hours
+    # step is the length of an hour in the units of the start/end columns
+    def __init__(self, df, start='starttime_elapsed', end='endtime_elapsed', step=1):
+        iid = df['icustay_id'].values.astype(int)
+        s = df[start].values.astype(float) / step
+        e = df[end].values.astype(float) / step
+
+        # drop ranges which are missing a time or end before they start
+        idxKeep = ~np.isnan(s) & ~np.isnan(e) & (e >= s)
+        iid, s, e = iid[idxKeep], s[idxKeep], e[idxKeep]
+
+        idxSort = np.lexsort((s, iid))
+        iid, s, e = iid[idxSort], s[idxSort], e[idxSort]
+
+        # a range starts a new interval if it begins after the end of all previous ranges of the stay
+        e_max = pd.Series(e).groupby(iid).cummax().values
+        idxNew = np.ones(iid.shape[0], dtype=bool)
+        idxNew[1:] = (iid[1:] != iid[:-1]) | (s[1:] > e_max[:-1])
+        idxStart = np.nonzero(idxNew)[0]
+
+        self.iid = iid[idxStart]
+        self.start = s[idxStart]
+        if idxStart.shape[0] > 0:
+            self.end = np.maximum.reduceat(e, idxStart)
+        else:
+            self.end = e
+
+        # cumulative duration of the intervals, for the hours covered in O(1) per window
+        self.duration = np.concatenate([[0], np.cumsum(self.end - self.start)])
+
+    def __len__(self):
+        return self.iid.shape[0]
+
+    def query(self, iid, t_start, t_end):
+        # for each window [t_start, t_end] of the stay iid, returns:
+        #   any - boolean, an interval overlaps the window (touching the edge counts)
+        #   all - boolean, the intervals cover the entire window
+        #   hours - the length of the window covered by intervals
+        iid = np.asarray(iid).astype(int)
+        t_start = np.asarray(t_start).astype(float)
+        t_end = np.asarray(t_end).astype(float)
+
+        # intervals [i, j) are those with end >= t_start and start <= t_end
+        # the ends are sorted within a stay as the intervals do not overlap
+        i = searchsorted_grouped(self.iid, self.end, iid, t_start, side='left')
+        j = searchsorted_grouped(self.iid, self.start, iid, t_end, side='right')
+        j = np.maximum(i, j)
+        idxAny = j > i
+
+        # all intervals in [i, j) are summed, then trimmed to the window at either end
+        hours = self.duration[j] - self.duration[i]
+        i_first = np.minimum(i, len(self) - 1)
+        i_last = np.maximum(j - 1, 0)
+        if len(self) > 0:
+            hours = hours - np.where(idxAny, np.maximum(t_start - self.start[i_first], 0), 0) \
+                          - np.where(idxAny, np.maximum(self.end[i_last] - t_end, 0), 0)
+        hours = np.maximum(hours, 0)
+
+        # as the intervals are merged, the window is covered only if a single interval covers it
+        idxAll = idxAny & (j - i == 1)
+        if len(self) > 0:
+            idxAll = idxAll & (self.start[i_first] <= t_start) & (self.end[i_first] >= t_end)
+
+        return idxAny, idxAll, hours
+
+    def get_features(self, iid, t, W=8, name='range'):
+        # features for each window [t-W, t], in the order requested
+        t = np.asarray(t).astype(float)
+        idxAny, idxAll, hours = self.query(iid, t-W, t)
+        return pd.DataFrame({name + '_any': idxAny.astype(float),
+                             name + '_all': idxAll.astype(float),
+                             name + '_hours': hours},
+                            columns=[name + '_any', name + '_all', name + '_hours'])
@@ -0,0 +1,142 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+import psycopg2
+
+# loads the hourly data (mp_data) in chunks of complete icustay_id
+# reading the full table with pd.read_sql_query takes ~2 minutes and
+# materializes ~5 million rows of float64/object columns at once
+# here the rows are streamed through a server-side cursor and each chunk
+# is downcast to compact dtypes before the next chunk is read
+
+
+def downcast_frame(df, force_float32=False):
+    # downcasts the columns of df in place to smaller dtypes where no information is lost
+    #   integer columns -> int16 or int32 if the values fit
+    #   float columns -> float32 if every value is exactly representable
+    # if force_float32 is True, all float columns are converted to float32 regardless,
+    # which is ~7 significant digits and sufficient for the charted/lab values in mp_data
+    for c in df.columns:
+        x = df[c].values
+        if x.dtype == object:
+            # numeric columns come back from postgres as Decimal
+            try:
+                x = x.astype(float)
+            except (TypeError, ValueError):
+                continue
+
+        if x.dtype.kind in ('i', 'u'):
+            if x.shape[0] == 0:
+                continue
+            for dtype in (np.int16, np.int32):
+                info = np.iinfo(dtype)
+                if x.min() >= info.min and x.max() <= info.max:
+                    x = x.astype(dtype)
+                    break
+        elif x.dtype.kind == 'f' and x.dtype != np.float32:
+            x32 = x.astype(np.float32)
+            if force_float32:
+                x = x32
+            elif np.array_equal(x32.astype(x.dtype), x, equal_nan=True):
+                x = x32
+        df[c] = x
+    return df
+
+
+def get_cursor(con, name='mp_data_cursor', itersize=100000):
+    # psycopg2 connections get a named (server-side) cursor, so rows are only
+    # transferred as they are fetched; other DB-API connections (e.g. sqlite3)
+    # get a regular cursor
+    if isinstance(con, psycopg2.extensions.connection):
+        cur = con.cursor(name=name)
+        cur.itersize = itersize
+    else:
+        cur = con.cursor()
+    return cur
+
+
+def iter_mp_data(con, chunksize=500000, columns=None, table='mp_data', schema_name=None,
+                 force_float32=False):
+    # yields dataframes of roughly chunksize rows, ordered by (icustay_id, hr)
+    # a stay is never split across two chunks
+    # columns is a list of columns to load (default: all)
+    if schema_name is not None:
+        cur = con.cursor()
+        cur.execute('SET search_path to public,' + schema_name)
+        cur.close()
+
+    if columns is None:
+        col_str = '*'
+    else:
+        col_str = ', '.join(columns)
+    query = 'select ' + col_str + ' from ' + table + ' order by icustay_id, hr'
+
+    cur = get_cursor(con, itersize=chunksize)
+    cur.execute(query)
+
+    def iter_chunks():
+        header = None
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if header is None:
+                header = [x[0] for x in cur.description]
+            if len(rows) == 0:
+                break
+            df = pd.DataFrame.from_records(rows, columns=header, coerce_float=True)
+            yield downcast_frame(df, force_float32=force_float32)
+
+    for df in iter_stays(iter_chunks()):
+        yield df
+    cur.close()
+
+
+def iter_stays(chunks):
+    # regroups an iterable of dataframes so that no icustay_id is split across two of them
+    # the rows of each stay must be contiguous, e.g. the source is ordered by icustay_id
+    df_carry = None
+    for df in chunks:
+        if df.shape[0] == 0:
+            continue
+        if df_carry is not None:
+            df = pd.concat([df_carry, df], ignore_index=True)
+
+        # hold back the last stay, as it may continue in the next chunk
+        iid = df['icustay_id'].values
+        idxLast = np.nonzero(iid != iid[-1])[0]
+        idxLast = idxLast[-1] + 1 if idxLast.shape[0] > 0 else 0
+        df_carry = df.iloc[idxLast:,:].reset_index(drop=True)
+        if idxLast > 0:
+            yield df.iloc[0:idxLast,:].reset_index(drop=True)
+
+    if df_carry is not None and df_carry.shape[0] > 0:
+        yield df_carry
+
+
+def iter_csv(filename, chunksize=500000, columns=None, force_float32=False, **kwargs):
+    # yields chunks of complete stays from a csv file ordered (or grouped) by icustay_id
+    reader = pd.read_csv(filename, chunksize=chunksize, usecols=columns, **kwargs)
+    return iter_stays(downcast_frame(df, force_float32=force_float32) for df in reader)
+
+
+def iter_parquet(filename, chunksize=500000, columns=None, force_float32=False):
+    # yields chunks of complete stays from a parquet file ordered (or grouped) by icustay_id
+    # requires pyarrow; only one row group batch is in memory at a time
+    import pyarrow.parquet as pq
+    pf = pq.ParquetFile(filename)
+    batches = pf.iter_batches(batch_size=chunksize, columns=columns)
+    return iter_stays(downcast_frame(b.to_pandas(), force_float32=force_float32) for b in batches)
+
+
+def load_mp_data(con, chunksize=500000, columns=None, table='mp_data', schema_name=None,
+                 force_float32=False):
+    # loads mp_data into a single compact dataframe, sorted by (icustay_id, hr)
+    df_list = list()
+    for df in iter_mp_data(con, chunksize=chunksize, columns=columns, table=table,
+                           schema_name=schema_name, force_float32=force_float32):
+        df_list.append(df)
+
+    if len(df_list) == 0:
+        return pd.DataFrame(columns=columns)
+
+    df = pd.concat(df_list, ignore_index=True)
+    return df
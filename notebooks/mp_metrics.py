@@ -0,0 +1,162 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+
+# vectorised evaluation of predictions: AUROC, AUPRC, and sensitivity/specificity/PPV/NPV
+# the predictions are sorted once, and every bootstrap resample (or fold) is a row of
+# weights over the sorted predictions - each metric is then a cumulative sum over the
+# distinct prediction values, computed for all resamples at once rather than one
+# call to sklearn per resample, e.g.
+#   res = bootstrap_metrics(y, prob, B=2000, thresholds=[0.1, 0.5])
+#   get_ci(res['auroc'])
+#   df = bootstrap_report({'base': {'xgb': (y, prob_xgb), 'lasso': (y, prob_lasso)}})
+# auroc and auprc agree with sklearn's roc_auc_score and average_precision_score
+
+
+def sort_predictions(y, prob):
+    # sorts the predictions in ascending order and groups tied values
+    # returns the sorted outcomes, the sorted distinct values, and the start of each group
+    y = np.asarray(y, dtype=float)
+    prob = np.asarray(prob, dtype=float)
+    idxSort = np.argsort(prob, kind='mergesort')
+    prob = prob[idxSort]
+    idxStart = np.concatenate([[0], np.nonzero(np.diff(prob))[0]+1]) if prob.shape[0] > 0 else np.zeros(0, dtype=int)
+    return idxSort, y[idxSort], prob[idxStart], idxStart
+
+
+def get_group_weights(w, y, idxStart):
+    # sums the positive and negative weights within each group of tied predictions
+    # w is an (B, n) array of weights in the sorted order
+    P = np.add.reduceat(w * y[np.newaxis,:], idxStart, axis=1)
+    N = np.add.reduceat(w * (1 - y)[np.newaxis,:], idxStart, axis=1)
+    return P, N
+
+
+def rank_statistics(P, N):
+    # AUROC and AUPRC from the group weights of each row (groups in ascending order of prediction)
+    Wp = P.sum(axis=1)
+    Wn = N.sum(axis=1)
+
+    # AUROC: probability a positive is ranked above a negative, with ties counting a half
+    N_below = np.cumsum(N, axis=1) - N
+    with np.errstate(invalid='ignore', divide='ignore'):
+        auroc = np.sum(P * (N_below + 0.5*N), axis=1) / (Wp * Wn)
+
+        # AUPRC (average precision): precision at each threshold, weighted by the increase in recall
+        # thresholds are the distinct predictions, in descending order
+        TP = np.cumsum(P[:,::-1], axis=1)
+        FP = np.cumsum(N[:,::-1], axis=1)
+        precision = TP / (TP + FP)
+        precision[TP + FP == 0] = 0
+        auprc = np.sum(P[:,::-1] * precision, axis=1) / Wp
+
+    # metrics are undefined without both classes
+    auroc[(Wp == 0) | (Wn == 0)] = np.nan
+    auprc[Wp == 0] = np.nan
+    return auroc, auprc
+
+
+def threshold_statistics(P, N, values, thresholds):
+    # sensitivity, specificity, PPV and NPV for predicting positive when prob >= threshold
+    # returns a dict of (B, n_thresholds) arrays
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype=float))
+    # number of groups below each threshold
+    k = np.searchsorted(values, thresholds, side='left')
+
+    cP = np.concatenate([np.zeros([P.shape[0], 1]), np.cumsum(P, axis=1)], axis=1)
+    cN = np.concatenate([np.zeros([N.shape[0], 1]), np.cumsum(N, axis=1)], axis=1)
+    Wp = cP[:,-1:]
+    Wn = cN[:,-1:]
+
+    FN = cP[:,k]
+    TN = cN[:,k]
+    TP = Wp - FN
+    FP = Wn - TN
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return OrderedDict([['sens', TP / (TP + FN)],
+                            ['spec', TN / (TN + FP)],
+                            ['ppv', TP / (TP + FP)],
+                            ['npv', TN / (TN + FN)]])
+
+
+def get_metrics(y, prob, w=None, thresholds=None):
+    # metrics for each row of weights w (B, n) - if w is None, all predictions have weight 1
+    # returns a dict with auroc and auprc as (B,) arrays, and, if thresholds are given,
+    # sens/spec/ppv/npv as (B, n_thresholds) arrays
+    idxSort, y_sorted, values, idxStart = sort_predictions(y, prob)
+    if w is None:
+        w = np.ones([1, y_sorted.shape[0]])
+    else:
+        w = np.atleast_2d(w)[:,idxSort]
+
+    P, N = get_group_weights(w, y_sorted, idxStart)
+    auroc, auprc = rank_statistics(P, N)
+    res = OrderedDict([['auroc', auroc], ['auprc', auprc]])
+    if thresholds is not None:
+        res.update(threshold_statistics(P, N, values, thresholds))
+    return res
+
+
+def get_bootstrap_weights(n, B, rng):
+    # the number of times each prediction is drawn in B resamples with replacement, as a (B, n) array
+    idx = rng.integers(0, n, size=[B, n]) + (np.arange(B) * n)[:,np.newaxis]
+    return np.bincount(idx.ravel(), minlength=B*n).reshape([B, n]).astype(float)
+
+
+def bootstrap_metrics(y, prob, B=2000, thresholds=None, seed=None, chunksize=100):
+    # metrics for B bootstrap resamples of the predictions
+    # the resamples are evaluated chunksize at a time to bound memory at ~chunksize * n values
+    rng = np.random.default_rng(seed)
+    idxSort, y_sorted, values, idxStart = sort_predictions(y, prob)
+    n = y_sorted.shape[0]
+
+    res = OrderedDict()
+    for b in range(0, B, chunksize):
+        # resampling the sorted predictions is equivalent to resampling the originals
+        w = get_bootstrap_weights(n, min(chunksize, B - b), rng)
+        P, N = get_group_weights(w, y_sorted, idxStart)
+        auroc, auprc = rank_statistics(P, N)
+        curr = OrderedDict([['auroc', auroc], ['auprc', auprc]])
+        if thresholds is not None:
+            curr.update(threshold_statistics(P, N, values, thresholds))
+        for m in curr:
+            res.setdefault(m, list()).append(curr[m])
+
+    return OrderedDict([[m, np.concatenate(res[m], axis=0)] for m in res])
+
+
+def fold_metrics(y, prob, idxK, thresholds=None):
+    # metrics for each fold, where idxK is the fold of each prediction (as in the notebooks)
+    # returns a dict of arrays with a row per fold, in order of the fold number
+    idxK = np.asarray(idxK)
+    folds = np.unique(idxK)
+    w = (idxK[np.newaxis,:] == folds[:,np.newaxis]).astype(float)
+    return get_metrics(y, prob, w=w, thresholds=thresholds)
+
+
+def get_ci(x, alpha=0.05):
+    # percentile confidence interval across resamples (the first axis), ignoring undefined resamples
+    return np.nanpercentile(x, 100.0*alpha/2, axis=0), np.nanpercentile(x, 100.0*(1-alpha/2), axis=0)
+
+
+def bootstrap_report(predictions, B=2000, thresholds=None, alpha=0.05, seed=None, chunksize=100):
+    # a table of metrics with confidence intervals for each experiment and model
+    # predictions is a dict of {experiment: {model: (y, prob)}}
+    # returns a dataframe with one row per (experiment, model, metric[, threshold])
+    rows = list()
+    for e in predictions:
+        for mdl in predictions[e]:
+            y, prob = predictions[e][mdl]
+            est = get_metrics(y, prob, thresholds=thresholds)
+            res = bootstrap_metrics(y, prob, B=B, thresholds=thresholds, seed=seed, chunksize=chunksize)
+            for m in res:
+                lower, upper = get_ci(res[m], alpha=alpha)
+                if m in ('auroc', 'auprc'):
+                    rows.append([e, mdl, m, np.nan, est[m][0], lower, upper])
+                else:
+                    for j, t in enumerate(np.atleast_1d(thresholds)):
+                        rows.append([e, mdl, m, t, est[m][0,j], lower[j], upper[j]])
+
+    return pd.DataFrame(rows, columns=['experiment', 'model', 'metric', 'threshold',
+                                       'estimate', 'lower', 'upper'])
@@ -2,173 +2,287 @@
 import numpy as np
 import pandas as pd
 import psycopg2
+import psycopg2.pool
 import sys
 import datetime as dt
-
-
-
-
-def query_metavision_patients(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii'):
-    # Connect to local postgres version of mimic
-    con = psycopg2.connect(dbname=dbname, user=sqluser)
-    cur = con.cursor()
-    cur.execute('SET search_path to ' + schema_name)
+import weakref
+from contextlib import contextmanager
+import mp_instrument
+
+# all the query functions share a pooled session, rather than each opening
+# a new connection, setting the search path, and closing the connection
+# the queries are prepared once per connection and executed with the icustay_id as a parameter
+
+# these are the per-patient queries, with $1 as the icustay_id
+query_text = dict()
+query_text['infusions'] = \
+"""
+select
+    mv.icustay_id
+    , starttime - ie.intime AS icustarttime
+    , endtime - ie.intime AS icuendtime
+    , di.label, amount, amountuom, rate, rateuom
+    , orderid, linkorderid, statusdescription
+from inputevents_mv mv
+inner join icustays ie
+    on mv.icustay_id = ie.icustay_id
+inner join d_items di
+    on mv.itemid = di.itemid
+where mv.icustay_id = $1
+order by mv.icustay_id, starttime, endtime, orderid
+"""
+
+query_text['codestatus'] = \
+"""
+select
+    ce.icustay_id
+    , charttime - ie.intime AS icutime
+    , di.label, ce.value
+from chartevents ce
+inner join icustays ie
+    on ce.icustay_id = ie.icustay_id
+inner join d_items di
+    on ce.itemid = di.itemid
+where ce.itemid in (128, 223758)
+and ce.icustay_id = $1
+and ce.error != 1
+order by ce.icustay_id, icutime
+"""
+
+query_text['charts'] = \
+"""
+select
+    ce.icustay_id
+    , ce.charttime
+    , charttime - ie.intime AS icutime
+    , di.label, ce.value
+    , ce.valuenum, ce.valueuom
+from chartevents ce
+inner join icustays ie
+    on ce.icustay_id = ie.icustay_id
+inner join d_items di
+    on ce.itemid = di.itemid
+where ce.icustay_id = $1
+and error != 1
+order by ce.icustay_id, icutime
+"""
+
+query_text['dbsource'] = \
+"""
+select icustay_id, dbsource
+from icustays
+where icustay_id = $1
+"""
+
+
+class Session(object):
+    # a pool of connections to the database, and a cache of the dbsource for each icustay_id
+    def __init__(self, sqluser='alistairewj', dbname='mimic', schema_name='mimiciii',
+                 minconn=1, maxconn=4):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn,
+                                                         dbname=dbname, user=sqluser,
+                                                         options='-c search_path=' + schema_name)
+        # names of statements prepared on each connection
+        # the pool closes connections beyond minconn when they are returned,
+        # so this is keyed weakly on the connection itself
+        self.prepared = weakref.WeakKeyDictionary()
+        self.dbsource = dict()
+
+    @contextmanager
+    def connection(self):
+        con = self.pool.getconn()
+        try:
+            yield con
+        finally:
+            # end the transaction so the connection is clean when returned to the pool
+            con.rollback()
+            self.pool.putconn(con)
+
+    def prepare(self, con, name):
+        # prepares the named query on this connection, if not already done
+        prepared = self.prepared.setdefault(con, set())
+        if name not in prepared:
+            cur = con.cursor()
+            cur.execute('PREPARE mp_' + name + ' (integer) AS ' + query_text[name])
+            cur.close()
+            con.commit()
+            prepared.add(name)
+
+    def execute(self, name, iid):
+        # runs a prepared per-patient query and returns a dataframe
+        with mp_instrument.timer('mp_queries.' + name, icustay_id=int(iid)) as rec:
+            with self.connection() as con:
+                self.prepare(con, name)
+                df = pd.read_sql_query('EXECUTE mp_' + name + ' (%(iid)s)', con, params={'iid': int(iid)})
+            rec['rows'] = df.shape[0]
+        return df
+
+    def query(self, query, params=None):
+        # runs an ad-hoc query and returns a dataframe
+        with mp_instrument.timer('mp_queries.query') as rec:
+            with self.connection() as con:
+                df = pd.read_sql_query(query, con, params=params)
+            rec['rows'] = df.shape[0]
+        return df
+
+    def execute_bulk(self, name, iid, chunksize=10000):
+        # runs a per-patient query for many icustay_id at once with "= ANY(array)"
+        # rows are streamed from a server-side cursor and yielded as (icustay_id, dataframe),
+        # one stay at a time, relying on the queries being ordered by icustay_id
+        iid = [int(i) for i in iid]
+        query = query_text[name].replace('$1', 'ANY(%(iid)s)')
+        with self.connection() as con:
+            cur = con.cursor(name='mp_bulk_' + name)
+            cur.itersize = chunksize
+            cur.execute(query, {'iid': iid})
+
+            header = None
+            rows = list()
+            while True:
+                chunk = cur.fetchmany(chunksize)
+                if header is None:
+                    header = [x[0] for x in cur.description]
+                if len(chunk) == 0:
+                    break
+                mp_instrument.count('mp_queries.' + name + '_bulk', rows=len(chunk))
+                for row in chunk:
+                    if len(rows) > 0 and row[0] != rows[-1][0]:
+                        yield rows[0][0], pd.DataFrame.from_records(rows, columns=header, coerce_float=True)
+                        rows = list()
+                    rows.append(row)
+            cur.close()
+
+            if len(rows) > 0:
+                yield rows[0][0], pd.DataFrame.from_records(rows, columns=header, coerce_float=True)
+
+    def get_dbsource_bulk(self, iid):
+        # looks up the dbsource for all icustay_id not already cached in a single query
+        iid = [int(i) for i in iid]
+        iid_new = [i for i in iid if i not in self.dbsource]
+        if len(iid_new) > 0:
+            db = self.query('select icustay_id, dbsource from icustays where icustay_id = ANY(%(iid)s)',
+                            params={'iid': iid_new})
+            for i in iid_new:
+                self.dbsource[i] = None
+            self.dbsource.update(zip(db['icustay_id'].astype(int), db['dbsource']))
+        return [self.dbsource[i] for i in iid]
+
+    def get_dbsource(self, iid):
+        # the dbsource is looked up once per icustay_id
+        iid = int(iid)
+        if iid not in self.dbsource:
+            db = self.execute('dbsource', iid)
+            if db.shape[0] == 0:
+                self.dbsource[iid] = None
+            else:
+                self.dbsource[iid] = db['dbsource'].values[0]
+        return self.dbsource[iid]
+
+    def close(self):
+        self.pool.closeall()
+        self.prepared = weakref.WeakKeyDictionary()
+
+
+# sessions are shared across calls with the same connection settings
+sessions = dict()
+
+def get_session(sqluser='alistairewj', dbname='mimic', schema_name='mimiciii'):
+    key = (sqluser, dbname, schema_name)
+    if key not in sessions:
+        sessions[key] = Session(sqluser=sqluser, dbname=dbname, schema_name=schema_name)
+    return sessions[key]
+
+
+def close_sessions():
+    for key in list(sessions.keys()):
+        sessions[key].close()
+        del sessions[key]
+
+
+def query_metavision_patients(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    if session is None:
+        session = get_session(sqluser=sqluser, dbname=dbname, schema_name=schema_name)
 
     query = \
     """
     select icustay_id, dbsource
     from icustays
     """
-    db = pd.read_sql_query(query,con)
-    cur.close()
-    con.close()
+    db = session.query(query)
+
+    # we have the dbsource of every icustay_id, so fill in the cache
+    session.dbsource.update(zip(db['icustay_id'].astype(int), db['dbsource']))
 
     db.set_index('icustay_id',inplace=True)
 
     return db.loc[db['dbsource']=='metavision',:].index.values
 
 
-def query_infusions(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii'):
-    # Connect to local postgres version of mimic
-    con = psycopg2.connect(dbname=dbname, user=sqluser)
-    cur = con.cursor()
-    cur.execute('SET search_path to ' + schema_name)
-
-    if 'float' in str(type(iid)) or 'int' in str(type(iid)):
-        iid_str = str(iid)
-    else:
-        iid_str = iid
-
-    query = \
-    """
-    select icustay_id, dbsource
-    from icustays
-    where icustay_id = """ + iid_str
-    db = pd.read_sql_query(query,con)
-    db.set_index('icustay_id',inplace=True)
-    db = db.loc[iid,'dbsource']
+def query_infusions(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    if session is None:
+        session = get_session(sqluser=sqluser, dbname=dbname, schema_name=schema_name)
 
+    db = session.get_dbsource(iid)
     if db != 'metavision':
         print('Cannot extract inputs for {} data.'.format(db))
         return None
 
+    df = session.execute('infusions', iid)
 
-    query = \
-    """
-    select
-        mv.icustay_id
-        , starttime - ie.intime AS icustarttime
-        , endtime - ie.intime AS icuendtime
-        , di.label, amount, amountuom, rate, rateuom
-        , orderid, linkorderid
-    from inputevents_mv mv
-    inner join icustays ie
-        on mv.icustay_id = ie.icustay_id
-    inner join d_items di
-        on mv.itemid = di.itemid
-    where mv.icustay_id = """ + iid_str + """
-    order by mv.icustay_id, starttime, endtime, orderid
-    """
+    return df
 
-    df = pd.read_sql_query(query,con)
-    cur.close()
-    con.close()
 
-    return df
+def query_codestatus(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    if session is None:
+        session = get_session(sqluser=sqluser, dbname=dbname, schema_name=schema_name)
 
+    db = session.get_dbsource(iid)
+    if db != 'metavision':
+        print('Cannot extract inputs for {} data.'.format(db))
+        return None
 
-def query_codestatus(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii'):
-    # Connect to local postgres version of mimic
-    con = psycopg2.connect(dbname=dbname, user=sqluser)
-    cur = con.cursor()
-    cur.execute('SET search_path to ' + schema_name)
+    df = session.execute('codestatus', iid)
 
-    if 'float' in str(type(iid)) or 'int' in str(type(iid)):
-        iid_str = str(iid)
-    else:
-        iid_str = iid
+    return df
 
-    query = \
-    """
-    select icustay_id, dbsource
-    from icustays
-    where icustay_id = """ + iid_str
-    db = pd.read_sql_query(query,con)
-    db.set_index('icustay_id',inplace=True)
-    db = db.loc[iid,'dbsource']
+def query_charts(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    if session is None:
+        session = get_session(sqluser=sqluser, dbname=dbname, schema_name=schema_name)
 
+    db = session.get_dbsource(iid)
     if db != 'metavision':
         print('Cannot extract inputs for {} data.'.format(db))
         return None
 
+    # Load chartevents
+    charts = session.execute('charts', iid)
 
-    query = \
-    """
-    select
-        ce.icustay_id
-        , charttime - ie.intime AS icutime
-        , di.label, ce.value
-    from chartevents ce
-    inner join icustays ie
-        on ce.icustay_id = ie.icustay_id
-    inner join d_items di
-        on ce.itemid = di.itemid
-    where ce.itemid in (128, 223758)
-    and ce.icustay_id = """ + iid_str + """
-    and ce.error != 1
-    order by ce.icustay_id, icutime
-    """
+    return charts
 
-    df = pd.read_sql_query(query,con)
-    cur.close()
-    con.close()
 
-    return df
+def query_bulk(name, iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    # runs the named query for all metavision stays in iid, yielding (icustay_id, dataframe)
+    if session is None:
+        session = get_session(sqluser=sqluser, dbname=dbname, schema_name=schema_name)
 
-def query_charts(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii'):
-    # Connect to local postgres version of mimic
-    con = psycopg2.connect(dbname=dbname, user=sqluser)
-    cur = con.cursor()
-    cur.execute('SET search_path to ' + schema_name)
+    db = session.get_dbsource_bulk(iid)
+    iid_mv = [i for i, d in zip(iid, db) if d == 'metavision']
+    if len(iid_mv) < len(iid):
+        print('Cannot extract inputs for {} of {} icustay_id (not metavision data).'.format(
+            len(iid) - len(iid_mv), len(iid)))
+    if len(iid_mv) == 0:
+        return iter([])
 
-    if 'float' in str(type(iid)) or 'int' in str(type(iid)):
-        iid_str = str(iid)
-    else:
-        iid_str = iid
+    return session.execute_bulk(name, iid_mv)
 
-    query = \
-    """
-    select icustay_id, dbsource
-    from icustays
-    where icustay_id = """ + iid_str
-    db = pd.read_sql_query(query,con)
-    db.set_index('icustay_id',inplace=True)
-    db = db.loc[iid,'dbsource']
 
-    if db != 'metavision':
-        print('Cannot extract inputs for {} data.'.format(db))
-        return None
+def query_infusions_bulk(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    return query_bulk('infusions', iid, sqluser=sqluser, dbname=dbname, schema_name=schema_name, session=session)
 
-    # Load chartevents
-    query = """
-    select
-        ce.icustay_id
-        , ce.charttime
-        , charttime - ie.intime AS icutime
-        , di.label, ce.value
-        , ce.valuenum, ce.valueuom
-    from chartevents ce
-    inner join icustays ie
-        on ce.icustay_id = ie.icustay_id
-    inner join d_items di
-        on ce.itemid = di.itemid
-    where ce.icustay_id = """ + iid_str + """
-    and error != 1
-    order by ce.icustay_id, icutime
-    """
 
-    charts = pd.read_sql_query(query,con)
-    cur.close()
-    con.close()
+def query_codestatus_bulk(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    return query_bulk('codestatus', iid, sqluser=sqluser, dbname=dbname, schema_name=schema_name, session=session)
 
-    return charts
+
+def query_charts_bulk(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    return query_bulk('charts', iid, sqluser=sqluser, dbname=dbname, schema_name=schema_name, session=session)
@@ -0,0 +1,92 @@
+# Import libraries
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import mp_queries
+
+# asyncio interface to the queries in mp_queries
+# psycopg2 is a blocking driver, so each query runs on a worker thread with its own
+# connection from the session's pool; there is one worker per connection, which bounds
+# the number of queries in flight against the database
+# e.g. in a notebook or service:
+#   session = AsyncSession(maxconn=8)
+#   async for iid, name, df in query_patients([200001, 200019], session=session):
+#       ...
+
+class AsyncSession(object):
+    def __init__(self, sqluser='alistairewj', dbname='mimic', schema_name='mimiciii', maxconn=8):
+        self.session = mp_queries.Session(sqluser=sqluser, dbname=dbname, schema_name=schema_name,
+                                          minconn=maxconn, maxconn=maxconn)
+        self.executor = ThreadPoolExecutor(max_workers=maxconn)
+
+    async def run(self, fcn, *args):
+        # runs one of the mp_queries functions on a worker thread
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(fcn, *args, session=self.session))
+
+    async def get_dbsource_bulk(self, iid):
+        # looks up the dbsource of all icustay_id in one query, so the queries which follow
+        # find it in the session's cache rather than each looking it up
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.session.get_dbsource_bulk, iid)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+
+# sessions are shared across calls with the same connection settings
+sessions = dict()
+
+def get_session(sqluser='alistairewj', dbname='mimic', schema_name='mimiciii', maxconn=8):
+    key = (sqluser, dbname, schema_name)
+    if key not in sessions:
+        sessions[key] = AsyncSession(sqluser=sqluser, dbname=dbname, schema_name=schema_name, maxconn=maxconn)
+    return sessions[key]
+
+
+def close_sessions():
+    for key in list(sessions.keys()):
+        sessions[key].close()
+        del sessions[key]
+
+
+query_functions = {'charts': mp_queries.query_charts,
+                   'infusions': mp_queries.query_infusions,
+                   'codestatus': mp_queries.query_codestatus}
+
+
+async def query_infusions(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    if session is None:
+        session = get_session(sqluser=sqluser, dbname=dbname, schema_name=schema_name)
+    return await session.run(mp_queries.query_infusions, iid)
+
+
+async def query_codestatus(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    if session is None:
+        session = get_session(sqluser=sqluser, dbname=dbname, schema_name=schema_name)
+    return await session.run(mp_queries.query_codestatus, iid)
+
+
+async def query_charts(iid, sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    if session is None:
+        session = get_session(sqluser=sqluser, dbname=dbname, schema_name=schema_name)
+    return await session.run(mp_queries.query_charts, iid)
+
+
+async def query_patients(iid, queries=('charts', 'infusions', 'codestatus'),
+                         sqluser='alistairewj', dbname='mimic',schema_name='mimiciii', session=None):
+    # runs each of the queries for each icustay_id concurrently
+    # yields (icustay_id, query name, dataframe) in the order they complete
+    if session is None:
+        session = get_session(sqluser=sqluser, dbname=dbname, schema_name=schema_name)
+    iid = list(iid)
+    await session.get_dbsource_bulk(iid)
+
+    async def run_one(i, name):
+        df = await session.run(query_functions[name], i)
+        return i, name, df
+
+    tasks = [run_one(i, name) for i in iid for name in queries]
+    for task in asyncio.as_completed(tasks):
+        yield await task
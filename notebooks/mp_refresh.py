@@ -0,0 +1,274 @@
+# Import libraries
+import re
+import sys
+import argparse
+import datetime as dt
+import numpy as np
+import pandas as pd
+import mp_instrument
+import mp_build
+
+# incremental refresh of the hourly tables (mp_hourly_cohort, the pivots, and mp_data)
+# for newly admitted stays, stays with new hours, and stays with new data since the last build
+# rather than rewriting the scripts in queries/, they are run unchanged within one transaction
+# against temporary objects which shadow their inputs:
+#   mp_cohort - only the stays being refreshed
+#   chartevents/labevents/outputevents - only the rows of those admissions from shortly
+#     before the first hour being refreshed
+# the rows of the temporary tables from the first refreshed hour on then replace those in the real
+# tables, and are returned as a delta of mp_data for downstream feature code, e.g.
+#   graph = mp_build.BuildGraph('../queries')
+#   for df_delta in iter_refresh(session, graph, stays={200001: 48}):
+#       ...
+# or from the command line:
+#   python mp_refresh.py --queries ../queries --output mp_data_delta.csv
+# mp_cohort is not refreshed here - it should be updated beforehand, with the current time
+# as the outtime of stays which are still in the ICU
+
+# the tables refreshed - every table created by the scripts which create these is refreshed
+refresh_tables = ['mp_hourly_cohort', 'mp_vital', 'mp_lab', 'mp_bg', 'mp_bg_art',
+                  'mp_gcs', 'mp_uo', 'mp_data']
+
+# source tables read by the scripts, shadowed by the rows of the admissions refreshed
+source_tables = ['chartevents', 'labevents', 'outputevents']
+
+# hours of data before the first refreshed hour which are read again, as some values
+# are carried forward (e.g. the previous GCS within 6 hours, SpO2/FiO2 within 4 hours of a blood gas)
+LOOKBACK = 24
+
+
+def get_refresh_stays(session, stays=None):
+    # the stays to refresh (see select_refresh_stays), from mp_cohort and mp_hourly_cohort
+    df = session.query("""
+    select co.icustay_id, co.hadm_id
+      , ceil(extract(EPOCH from co.outtime-co.intime)/60.0/60.0)::INTEGER as hr_max
+      , h.hr_last
+    from mp_cohort co
+    left join
+    (
+      select icustay_id, max(hr) as hr_last
+      from mp_hourly_cohort
+      group by icustay_id
+    ) h
+      on co.icustay_id = h.icustay_id
+    where co.excluded = 0
+    """)
+    return select_refresh_stays(df, stays=stays)
+
+
+def select_refresh_stays(df, stays=None):
+    # the stays to refresh and the first hour to refresh for each (-inf for all hours):
+    #   new stays - in mp_cohort but not in mp_hourly_cohort
+    #   extended stays - with hours after the last hour in mp_hourly_cohort, which is refreshed
+    #     as well, as it may have been only partly observed
+    #   stays - a dict of {icustay_id: hour} for stays with new data from that hour on
+    # df has a row per stay of the cohort: icustay_id, hadm_id, hr_max (the last hour of the stay),
+    # and hr_last (the last hour in mp_hourly_cohort, null for new stays)
+    # stays given which are not in the cohort are ignored
+    df = df.copy()
+    hr_last = df['hr_last'].values.astype(float)
+    hr_from = np.where(hr_last < df['hr_max'].values, hr_last, np.inf)
+    hr_from[np.isnan(hr_last)] = -np.inf
+    if stays is not None:
+        hr_from = np.fmin(hr_from, df['icustay_id'].map(stays).values.astype(float))
+
+    # the lab and blood gas pivots are keyed on hadm_id, with hours relative to each stay of the admission,
+    # so if one stay of an admission is refreshed, all stays of the admission are refreshed in full
+    n_stays = df.groupby('hadm_id')['icustay_id'].transform('size').values
+    idx = (n_stays > 1) & np.isin(df['hadm_id'].values, df['hadm_id'].values[hr_from < np.inf])
+    hr_from[idx] = -np.inf
+
+    df['hr_from'] = hr_from
+    df = df.loc[hr_from < np.inf, ['icustay_id', 'hadm_id', 'hr_from']]
+    return df.sort_values(['hadm_id', 'icustay_id']).reset_index(drop=True)
+
+
+def get_refresh_scripts(graph):
+    # the scripts which create the refreshed tables, in build order
+    names = set()
+    for t in refresh_tables:
+        if t not in graph.creator:
+            raise ValueError('No script in {} creates {}.'.format(graph.path, t))
+        names.add(graph.creator[t])
+    return [name for name in graph.order if name in names]
+
+
+def get_table_schemas(cur, tables):
+    # the schema of each table on the search path, so it can be referred to once shadowed
+    cur.execute("""
+    select c.relname, n.nspname
+    from pg_class c
+    inner join pg_namespace n
+      on c.relnamespace = n.oid
+    where c.relname = ANY(%(t)s)
+    and pg_table_is_visible(c.oid)
+    """, {'t': list(tables)})
+    schemas = dict(cur.fetchall())
+    missing = [t for t in tables if t not in schemas]
+    if len(missing) > 0:
+        raise ValueError('Tables not found: {}. Build them with mp_build first.'.format(', '.join(missing)))
+    return schemas
+
+
+def to_temp(sql):
+    # rewrites a script to create temporary tables, which shadow the real tables for this session
+    sql = re.sub(r'drop\s+table\s+if\s+exists\s+[\w.]+(\s+cascade)?\s*;', '', sql, flags=re.IGNORECASE)
+    return re.sub(r'create\s+table\s+', 'CREATE TEMPORARY TABLE ', sql, flags=re.IGNORECASE)
+
+
+def refresh_batch(con, graph, scripts, df_stays, lookback=LOOKBACK):
+    # refreshes the stays in df_stays (from get_refresh_stays) in one transaction
+    # returns the rows of mp_data which were added or recomputed
+    cur = con.cursor()
+    tables = [t for name in scripts for t in graph.tables[name]]
+    schemas = get_table_schemas(cur, ['mp_cohort'] + source_tables + tables)
+    hr_from = df_stays['hr_from'].values
+    params = {'iid': [int(x) for x in df_stays['icustay_id'].values],
+              'hadm': [int(x) for x in df_stays['hadm_id'].values],
+              'hr': [None if np.isinf(x) else int(x) for x in hr_from],
+              'lookback': int(lookback)}
+
+    with mp_instrument.timer('mp_refresh.shadow', stays=len(params['iid'])):
+        # the source rows of each admission are read from lookback hours before its first refreshed hour
+        cur.execute("""
+        create temporary table mp_refresh_stays as
+        select s.icustay_id, s.hadm_id, s.hr_from
+          , case when s.hr_from is null then '-infinity'::timestamp
+              else co.intime + (s.hr_from - 1 - %(lookback)s) * interval '1' hour end as starttime
+        from unnest(%(iid)s::integer[], %(hadm)s::integer[], %(hr)s::integer[]) as s(icustay_id, hadm_id, hr_from)
+        inner join {}.mp_cohort co
+          on s.icustay_id = co.icustay_id;
+
+        create temporary table mp_refresh_hadm as
+        select hadm_id
+          , case when bool_or(hr_from is null) then null else min(hr_from) end as hr_from
+          , min(starttime) as starttime
+        from mp_refresh_stays
+        group by hadm_id;
+        """.format(schemas['mp_cohort']), params)
+
+        cur.execute("""
+        create temporary table mp_cohort as
+        select co.*
+        from {}.mp_cohort co
+        inner join mp_refresh_stays s
+          on co.icustay_id = s.icustay_id
+        """.format(schemas['mp_cohort']))
+
+        for t in source_tables:
+            cur.execute("""
+            create temporary view {t} as
+            select x.*
+            from {schema}.{t} x
+            inner join mp_refresh_hadm h
+              on x.hadm_id = h.hadm_id
+            where x.charttime >= h.starttime
+            """.format(t=t, schema=schemas[t]))
+
+    for name in scripts:
+        with mp_instrument.timer('mp_refresh.' + name):
+            cur.execute(to_temp(graph.sql[name]))
+
+    # replace the refreshed rows of each table: rows keyed on icustay_id are replaced from the first refreshed
+    # hour of the stay, rows keyed on hadm_id from the first refreshed hour (or charttime) of the admission
+    for t in tables:
+        cur.execute('select * from pg_temp.{} limit 0'.format(t))
+        columns = [c[0] for c in cur.description]
+        if 'icustay_id' in columns:
+            key, keys = 'icustay_id', 'mp_refresh_stays'
+        else:
+            key, keys = 'hadm_id', 'mp_refresh_hadm'
+        if 'hr' in columns:
+            where = '(s.hr_from is null or x.hr >= s.hr_from)'
+        else:
+            where = 'x.charttime >= s.starttime'
+
+        with mp_instrument.timer('mp_refresh.replace', table=t) as rec:
+            cur.execute('delete from {schema}.{t} x using {keys} s where x.{key} = s.{key} and {where}'.format(
+                schema=schemas[t], t=t, keys=keys, key=key, where=where))
+            rec['deleted'] = cur.rowcount
+            cur.execute("""
+            insert into {schema}.{t} ({columns})
+            select {x_columns}
+            from pg_temp.{t} x
+            inner join {keys} s
+              on x.{key} = s.{key}
+            where {where}
+            """.format(schema=schemas[t], t=t, keys=keys, key=key, where=where,
+                       columns=', '.join(columns), x_columns=', '.join(['x.' + c for c in columns])))
+            rec['inserted'] = cur.rowcount
+
+    df_delta = pd.read_sql_query("""
+    select x.*
+    from pg_temp.mp_data x
+    inner join mp_refresh_stays s
+      on x.icustay_id = s.icustay_id
+    where s.hr_from is null or x.hr >= s.hr_from
+    order by x.icustay_id, x.hr
+    """, con)
+    con.commit()
+
+    # the temporary objects persist for the life of the connection, which is returned to the pool
+    cur.execute('DISCARD TEMP')
+    con.commit()
+    cur.close()
+    return df_delta
+
+
+def iter_refresh(session, graph, stays=None, batchsize=1000, lookback=LOOKBACK, verbose=True):
+    # refreshes batchsize admissions at a time, each batch in its own transaction
+    # yields the delta of mp_data for each batch (see refresh_batch)
+    df_stays = get_refresh_stays(session, stays=stays)
+    scripts = get_refresh_scripts(graph)
+    hadm_ids = df_stays['hadm_id'].unique()
+    if verbose:
+        print('{} - {} stays to refresh.'.format(dt.datetime.now(), df_stays.shape[0]))
+
+    for i in range(0, hadm_ids.shape[0], batchsize):
+        df_batch = df_stays.loc[df_stays['hadm_id'].isin(hadm_ids[i:i+batchsize]), :]
+        with mp_instrument.timer('mp_refresh.batch', stays=df_batch.shape[0]) as rec:
+            with session.connection() as con:
+                df_delta = refresh_batch(con, graph, scripts, df_batch, lookback=lookback)
+            rec['rows'] = df_delta.shape[0]
+        if verbose:
+            print('{} - refreshed {} stays ({} rows of mp_data).'.format(dt.datetime.now(), df_batch.shape[0],
+                                                                        df_delta.shape[0]))
+        yield df_delta
+
+
+def refresh(session, graph, stays=None, batchsize=1000, lookback=LOOKBACK, verbose=True):
+    # refreshes all stays, returning the delta of mp_data as one dataframe
+    deltas = list(iter_refresh(session, graph, stays=stays, batchsize=batchsize,
+                               lookback=lookback, verbose=verbose))
+    if len(deltas) == 0:
+        return pd.DataFrame()
+    return pd.concat(deltas, ignore_index=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Refresh the hourly tables for new stays and new hours.')
+    parser.add_argument('--queries', default='../queries', help='directory of sql scripts')
+    parser.add_argument('--sqluser', default='alistairewj')
+    parser.add_argument('--dbname', default='mimic')
+    parser.add_argument('--schema', default='mimiciii', help='schema of the mimic tables, searched after public')
+    parser.add_argument('--batchsize', type=int, default=1000, help='admissions refreshed per transaction')
+    parser.add_argument('--lookback', type=int, default=LOOKBACK, help='hours of source data read before each refresh')
+    parser.add_argument('--output', default=None, help='csv file the mp_data deltas are appended to')
+    args = parser.parse_args(argv)
+
+    import mp_queries
+    graph = mp_build.BuildGraph(args.queries)
+    session = mp_queries.Session(sqluser=args.sqluser, dbname=args.dbname, schema_name='public,' + args.schema)
+    try:
+        header = True
+        for df_delta in iter_refresh(session, graph, batchsize=args.batchsize, lookback=args.lookback):
+            if args.output is not None and df_delta.shape[0] > 0:
+                df_delta.to_csv(args.output, mode='w' if header else 'a', header=header, index=False)
+                header = False
+    finally:
+        session.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
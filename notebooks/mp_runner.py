@@ -0,0 +1,172 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+import datetime as dt
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import sklearn
+from sklearn import metrics
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+import mp_utils as mp
+
+# older versions of sklearn (as used in the notebooks) have Imputer rather than SimpleImputer
+try:
+    from sklearn.impute import SimpleImputer
+except ImportError:
+    from sklearn.preprocessing import Imputer as SimpleImputer
+
+# runs the cross-validation in the evaluation notebooks in parallel
+# every (experiment, model, fold) is a separate task for a process pool
+# the design matrices are placed in shared memory once, and workers map them
+# rather than receiving a pickled copy with every task
+# results are returned as results_all[experiment][model] = [AUROC for each fold],
+# i.e. results_all[e] is the results_val dict expected by mp.plot_model_results
+
+
+def get_pipeline(mdl, model):
+    # no pre-processing of data necessary for xgb
+    # other models impute the mean and standardize for computational stability
+    if mdl == 'xgb':
+        return Pipeline([(mdl, model)])
+    return Pipeline([("imputer", SimpleImputer(strategy="mean")),
+                     ("scaler", StandardScaler()),
+                     (mdl, model)])
+
+
+def get_folds(subject_id, K=5, seed=111):
+    # assigns each row to one of K folds, keeping all stays of a subject_id in the same fold
+    sid = np.sort(np.unique(subject_id))
+    idxK_sid = np.random.default_rng(seed).permutation(sid.shape[0])
+    idxK_sid = np.mod(idxK_sid, K)
+    idxMap = np.searchsorted(sid, subject_id)
+    return idxK_sid[idxMap]
+
+
+def build_design_matrices(df, df_death, df_static, experiments, T=2, W_extra=24, death_epsilon=2):
+    # creates the data for each experiment, as in mp-random-time-evaluation
+    # experiments is an OrderedDict of name: [seed, W (window size), T_to_death]
+    # all window times are drawn in one call to mp.generate_times_array
+    # returns dicts of X, y, icustay_id, and the column names for each experiment
+    var_static = mp.vars_of_interest()[7]
+    names = list(experiments.keys())
+    seed = [experiments[e][0] for e in names]
+    T_to_death = [experiments[e][2] for e in names]
+    iid, windowtime = mp.generate_times_array(df_death, seed, T=T, T_to_death=T_to_death)
+
+    df_static = df_static.set_index('icustay_id')[var_static]
+    df_outcome = df_death.set_index('icustay_id')
+
+    X_all, y_all, iid_all, X_header_all = dict(), dict(), dict(), dict()
+    for i, e in enumerate(names):
+        W = experiments[e][1]
+        df_data = mp.get_design_matrix(df, windowtime[i,:], W=W, W_extra=W_extra, iid=iid)
+
+        # add in static vars from df_static
+        X = df_data.merge(df_static, how='left', left_index=True, right_index=True)
+
+        if experiments[e][2] is not None:
+            y = (df_outcome['deathtime_hours'] <= (df_outcome['dischtime_hours'] + experiments[e][2] + death_epsilon)).astype(float)
+        else:
+            y = df_outcome['death'].astype(float)
+        y = y.reindex(X.index)
+        idxKeep = ~y.isnull().values
+
+        iid_all[e] = X.index.values[idxKeep]
+        X_all[e] = np.ascontiguousarray(X.values[idxKeep,:], dtype=float)
+        y_all[e] = y.values[idxKeep]
+        X_header_all[e] = list(df_data.columns) + var_static
+
+    return X_all, y_all, iid_all, X_header_all
+
+
+def to_shared(x):
+    # copies x into a new shared memory block, returning the block and a picklable reference
+    shm = shared_memory.SharedMemory(create=True, size=max(x.nbytes, 1))
+    arr = np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)
+    arr[...] = x
+    return shm, (shm.name, x.shape, x.dtype.str)
+
+
+# shared memory blocks which a worker has attached to, by name
+attached = dict()
+
+def from_shared(ref):
+    name, shape, dtype = ref
+    if name not in attached:
+        # workers share the resource tracker of the parent, which unlinks the block
+        attached[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=attached[name].buf)
+
+
+def run_fold(e, mdl, estimator, X_ref, y_ref, idxK_ref, k, return_model=False):
+    # trains the model using all but the kth fold, and evaluates it on the kth fold
+    X = from_shared(X_ref)
+    y = from_shared(y_ref)
+    idxK = from_shared(idxK_ref)
+
+    curr_mdl = sklearn.base.clone(estimator).fit(X[idxK != k, :], y[idxK != k])
+
+    # get prediction on this dataset
+    if mdl == 'lasso':
+        curr_prob = curr_mdl.predict(X[idxK == k, :])
+    else:
+        curr_prob = curr_mdl.predict_proba(X[idxK == k, :])
+        curr_prob = curr_prob[:,1]
+
+    # calculate score (AUROC)
+    curr_score = metrics.roc_auc_score(y[idxK == k], curr_prob)
+
+    if not return_model:
+        curr_mdl = None
+    return e, mdl, k, curr_score, curr_mdl
+
+
+def run_experiments(X_all, y_all, idxK_all, models, K=5, n_jobs=None, return_models=False, verbose=True):
+    # runs K-fold cross-validation of every model on every experiment in a process pool
+    #   X_all, y_all, idxK_all - dicts of data, outcome, and fold index for each experiment
+    #   models - dict of model name: (unfitted) model, as in the notebooks
+    # returns results_all[e][mdl], a list of K AUROCs, and optionally the fitted models
+    # in mdl_all[e][mdl], a list of K models
+    shm_list = list()
+    refs = dict()
+    try:
+        for e in X_all:
+            refs[e] = list()
+            for x in [X_all[e], y_all[e], idxK_all[e]]:
+                shm, ref = to_shared(np.ascontiguousarray(x))
+                shm_list.append(shm)
+                refs[e].append(ref)
+
+        results_all = OrderedDict()
+        mdl_all = OrderedDict()
+        for e in X_all:
+            results_all[e] = OrderedDict([[mdl, [None]*K] for mdl in models])
+            mdl_all[e] = OrderedDict([[mdl, [None]*K] for mdl in models])
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            tasks = list()
+            for e in X_all:
+                for mdl in models:
+                    estimator = get_pipeline(mdl, models[mdl])
+                    for k in range(K):
+                        tasks.append(executor.submit(run_fold, e, mdl, estimator,
+                                                     refs[e][0], refs[e][1], refs[e][2], k,
+                                                     return_model=return_models))
+
+            for task in as_completed(tasks):
+                e, mdl, k, curr_score, curr_mdl = task.result()
+                results_all[e][mdl][k] = curr_score
+                mdl_all[e][mdl][k] = curr_mdl
+                if verbose:
+                    print('{} - {:10s} - {:6s} - Finished fold {} of {}. AUROC {:0.3f}.'.format(
+                        dt.datetime.now(), e, mdl, k+1, K, curr_score))
+    finally:
+        for shm in shm_list:
+            shm.close()
+            shm.unlink()
+
+    if return_models:
+        return results_all, mdl_all
+    return results_all
@@ -0,0 +1,259 @@
+# Import libraries
+import numpy as np
+import sys
+import json
+import time
+import pickle
+import argparse
+import threading
+from concurrent.futures import Future
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import mp_instrument
+import mp_utils as mp
+
+# scoring service for the fold models trained in the notebooks
+# the models are loaded once and kept in memory; requests are queued and a single worker
+# thread coalesces the requests waiting into one batch, so each fold model gets one
+# predict_proba call per batch rather than one per row
+# each result has the probability from each fold model and the min/mean/max across folds,
+# as plotted in mp-random-time-evaluation, e.g. in-process:
+#   service = ScoringService(mdl_val['xgb'])
+#   res = service.score(mp.get_data_at_time(df, df_static, iid, hour=25))
+#   res['mean']
+# or over http:
+#   python mp_service.py --models xgb_fold0.pkl xgb_fold1.pkl ... --port 8765
+#   curl -X POST localhost:8765/score -d '{"X": [[...]]}'
+
+
+def load_models(filenames):
+    # loads pickled models - each file has either one model or a list of models (e.g. one per fold)
+    models = list()
+    for fn in filenames:
+        with open(fn, 'rb') as fp:
+            mdl = pickle.load(fp)
+        if isinstance(mdl, (list, tuple)):
+            models.extend(mdl)
+        else:
+            models.append(mdl)
+    return models
+
+
+def predict(mdl, X):
+    # lasso is a regression model without predict_proba, as in mp_runner.run_fold
+    if hasattr(mdl, 'predict_proba'):
+        return mdl.predict_proba(X)[:,1]
+    return mdl.predict(X)
+
+
+def get_n_features(models):
+    # the number of features the models were fitted with (sklearn's n_features_in_),
+    # or None if no model records it
+    n = set()
+    for mdl in models:
+        try:
+            n.add(int(getattr(mdl, 'n_features_in_')))
+        except Exception:
+            continue
+    if len(n) > 1:
+        raise ValueError('The models were fitted with different numbers of features: {}.'.format(sorted(n)))
+    return n.pop() if len(n) == 1 else None
+
+
+class ScoringService(object):
+    def __init__(self, models, max_batch=1024, max_delay=0.002, n_features=None):
+        # models - list of fitted models (or a dict, e.g. mdl_val[mdl] from the notebooks)
+        # max_batch - the most rows scored in one batch
+        # max_delay - seconds to wait for more requests after the first arrives
+        # n_features - columns expected in each request (default: from the models, if they record it)
+        if isinstance(models, dict):
+            models = [models[k] for k in sorted(models.keys())]
+        self.models = list(models)
+        self.n_features = get_n_features(self.models) if n_features is None else n_features
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.running = True
+        self.worker = threading.Thread(target=self.run, name='mp_service')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, X):
+        # queues the rows of X for scoring, returning a Future of the result
+        X = np.asarray(X, dtype=float)
+        if X.ndim == 1:
+            X = X[np.newaxis,:]
+        # a request of the wrong shape is rejected here, rather than failing the batch it joins
+        if X.ndim != 2:
+            raise ValueError('Expected a 2D array of features, got {} dimensions.'.format(X.ndim))
+        if self.n_features is not None and X.shape[1] != self.n_features:
+            raise ValueError('Expected {} features, got {}.'.format(self.n_features, X.shape[1]))
+        future = Future()
+        with self.cond:
+            if not self.running:
+                raise RuntimeError('The scoring service has been closed.')
+            self.queue.append((X, future))
+            self.cond.notify()
+        return future
+
+    def score(self, X, timeout=None):
+        # scores the rows of X and waits for the result
+        return self.submit(X).result(timeout=timeout)
+
+    def get_batch(self):
+        # waits for a request, then for up to max_delay for more to arrive
+        with self.cond:
+            while self.running and len(self.queue) == 0:
+                self.cond.wait()
+            if len(self.queue) == 0:
+                return list()
+
+            deadline = time.time() + self.max_delay
+            n = self.queue[0][0].shape[0]
+            while self.running and n < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+                n = sum(x.shape[0] for x, f in self.queue)
+
+            batch = [self.queue.popleft()]
+            n = batch[0][0].shape[0]
+            while len(self.queue) > 0 and n + self.queue[0][0].shape[0] <= self.max_batch:
+                batch.append(self.queue.popleft())
+                n += batch[-1][0].shape[0]
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.get_batch()
+            if len(batch) == 0:
+                return
+
+            batch = [(X, f) for X, f in batch if f.set_running_or_notify_cancel()]
+
+            # requests with different numbers of columns (if the models do not record how many they expect)
+            # are scored separately, so only the requests of the wrong width fail
+            for width in sorted(set(X.shape[1] for X, f in batch)):
+                group = [(X, f) for X, f in batch if X.shape[1] == width]
+                try:
+                    self.score_batch(group)
+                except Exception as e:
+                    for X, f in group:
+                        if not f.done():
+                            f.set_exception(e)
+
+    def score_batch(self, batch):
+        # scores the requests of a batch together, and sets the result of each
+        with mp_instrument.timer('mp_service.predict', requests=len(batch)) as rec:
+            X = np.concatenate([X for X, f in batch], axis=0)
+            prob = np.column_stack([predict(mdl, X) for mdl in self.models])
+            rec['rows'] = X.shape[0]
+
+        i = 0
+        for X, f in batch:
+            p = prob[i:i+X.shape[0],:]
+            i += X.shape[0]
+            f.set_result({'prob': p,
+                          'min': np.min(p, axis=1),
+                          'mean': np.mean(p, axis=1),
+                          'max': np.max(p, axis=1)})
+
+    def close(self):
+        # stops the worker once the queued requests are scored
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.worker.join()
+        # anything submitted after the worker exited is cancelled
+        while len(self.queue) > 0:
+            self.queue.popleft()[1].cancel()
+
+
+def get_data_at_times(df, df_static, iid, hours):
+    # feature rows for the given hours of a stay, built as in mp_utils.get_data_at_time
+    # unlike get_data_at_time, the hours are used as given rather than the closest hour in the data
+    hours = np.atleast_1d(hours)
+    df = df.loc[df['icustay_id']==iid,:]
+    return mp.get_design_matrix_at_times(df, df_static, np.repeat(iid, hours.shape[0]), hours, W=4, W_extra=24)
+
+
+def score_stay(service, df, df_static, iid):
+    # scores every hour of a stay, as get_predictions does for each fold model
+    # returns the hours and the result from the service
+    df = df.loc[df['icustay_id']==iid,:]
+    tm = df['hr'].values
+    X = mp.get_design_matrix_at_times(df, df_static, np.repeat(iid, tm.shape[0]), tm, W=4, W_extra=24)
+    return tm, service.score(X)
+
+
+def to_json(res):
+    return json.dumps({k: res[k].tolist() for k in res})
+
+
+def get_handler(service):
+    class ScoringHandler(BaseHTTPRequestHandler):
+        # POST /score with a json body {"X": [[...], ...]} (null for missing values)
+        def do_POST(self):
+            if self.path.rstrip('/') != '/score':
+                self.send_error(404)
+                return
+            try:
+                n = int(self.headers.get('Content-Length', 0))
+                X = json.loads(self.rfile.read(n).decode('utf-8'))['X']
+                X = np.array(X, dtype=float)
+                body = to_json(service.score(X)).encode('utf-8')
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+            except Exception as e:
+                # e.g. a model failing to score the batch
+                self.send_error(500, str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # requests are not logged to stderr
+            pass
+
+    return ScoringHandler
+
+
+def serve(service, host='127.0.0.1', port=8765):
+    # returns an http server for the scoring service (call serve_forever to start it)
+    # each request is handled on its own thread, and concurrent requests are batched by the service
+    server = ThreadingHTTPServer((host, port), get_handler(service))
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve pickled fold models over a local http port.')
+    parser.add_argument('--models', nargs='+', required=True, help='pickled model files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--max-batch', type=int, default=1024, help='the most rows scored in one batch')
+    parser.add_argument('--max-delay', type=float, default=0.002, help='seconds to wait to fill a batch')
+    args = parser.parse_args(argv)
+
+    service = ScoringService(load_models(args.models), max_batch=args.max_batch, max_delay=args.max_delay)
+    server = serve(service, host=args.host, port=args.port)
+    print('Serving {} models on {}:{}.'.format(len(service.models), args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+import mp_instrument
+import mp_intervals
+
+# hourly SOFA and vasopressor rates computed in memory, on the hourly grid of mp_data
+# this follows sofa_queries/sofa.sql and the vasopressors/*.sql scripts, but gives a rolling value
+# for every hour of every stay, without re-running the queries, e.g.
+#   df_inf = pd.concat([d for i, d in mp_queries.query_infusions_bulk(iid)])
+#   df_rates = get_vasopressor_rates(df_inf, df_weight=df_wt, intime=df_static.set_index('icustay_id')['intime'])
+#   df_sofa = get_sofa(df, df_rates=df_rates, df_vent=data['vent'])
+#   sofa = get_sofa_at_times(df_sofa, time_dict)
+# df_inf is shaped as the output of query_infusions, and df_wt as the weightdurations table
+# query_infusions only extracts metavision stays (inputevents_mv), so carevue stays have no vasopressor
+# rates and their cardiovascular SOFA is scored from the mean blood pressure alone
+# differences from the sql:
+#   - each row of inputevents_mv has one rate, so the rate at an hour is that of the rows running at
+#     the end of the hour, rather than the maximum rate across the order (linkorderid)
+#   - mp_data has the hourly mean blood pressure and GCS rather than the hourly minimum
+#   - ventilation is from the vent range table (or column) during the hour, rather than at the blood gas
+
+# labels of the vasopressors in d_items (metavision first, then carevue)
+vaso_labels = OrderedDict([
+    ['norepinephrine', ['norepinephrine', 'levophed', 'levophed-k']],
+    ['epinephrine', ['epinephrine', 'epinephrine-k', 'epinephrine drip']],
+    ['dopamine', ['dopamine', 'dopamine drip']],
+    ['dobutamine', ['dobutamine', 'dobutamine drip']]])
+
+# multiplier to mcg/min (or mcg/kg/min), and whether the unit is already normalised to weight
+# rates in other units (e.g. mL/hr) are ignored
+rate_units = {'mcg/kg/min': (1.0, True),
+              'mcg/min': (1.0, False),
+              'mg/kg/min': (1000.0, True),
+              'mg/min': (1000.0, False),
+              'mcg/kg/hr': (1.0/60.0, True),
+              'mcg/hr': (1.0/60.0, False)}
+
+# weight used if a stay has no weight at the time of the infusion, as in vasopressors/*.sql
+DEFAULT_WEIGHT = 80.0
+
+# length of the rolling window, as in sofa.sql (ROWS BETWEEN 24 PRECEDING AND 0 FOLLOWING)
+W_SOFA = 24
+
+sofa_components = ['respiration', 'coagulation', 'liver', 'cardiovascular', 'cns', 'renal']
+
+
+def get_hours(x, iid=None, intime=None):
+    # converts times to hours since ICU admission:
+    #   timedeltas (e.g. icustarttime from query_infusions) are converted directly
+    #   timestamps (e.g. starttime in weightdurations) need the intime of each stay (a series indexed by icustay_id)
+    #   numbers are assumed to be in hours already
+    x = pd.Series(np.asarray(x))
+    if pd.api.types.is_timedelta64_dtype(x):
+        return x.dt.total_seconds().values / 3600.0
+    if pd.api.types.is_datetime64_any_dtype(x):
+        if intime is None:
+            raise ValueError('intime is needed to convert timestamps to hours.')
+        t0 = pd.to_datetime(pd.Series(np.asarray(iid)).map(intime))
+        return (x - t0).dt.total_seconds().values / 3600.0
+    return x.values.astype(float)
+
+
+def get_weights(df_weight, iid, t, intime=None):
+    # weight of each stay at each time (hours), from a table shaped as weightdurations
+    # if more than one weight applies, the one which started last is used; missing if none applies
+    w = np.full(iid.shape[0], np.nan)
+    if df_weight is None or df_weight.shape[0] == 0:
+        return w
+    wt_iid = df_weight['icustay_id'].values.astype(int)
+    wt_start = get_hours(df_weight['starttime'], iid=wt_iid, intime=intime)
+    wt_end = get_hours(df_weight['endtime'], iid=wt_iid, intime=intime)
+    wt = df_weight['weight'].values.astype(float)
+
+    idxSort = np.lexsort((wt_start, wt_iid))
+    wt_iid, wt_start, wt_end, wt = wt_iid[idxSort], wt_start[idxSort], wt_end[idxSort], wt[idxSort]
+
+    # the last weight starting at or before t, if it has not yet ended
+    j = mp_intervals.searchsorted_grouped(wt_iid, wt_start, iid, t, side='right') - 1
+    idx = j >= 0
+    idx[idx] = (wt_iid[j[idx]] == iid[idx]) & (wt_end[j[idx]] >= t[idx])
+    w[idx] = wt[j[idx]]
+    return w
+
+
+def get_vasopressor_rates(df_inf, df_weight=None, intime=None):
+    # rates of each vasopressor in mcg/kg/min from a table shaped as the output of query_infusions
+    # returns a dataframe with one row per infusion: icustay_id, drug, starttime, endtime (hours), rate
+    label = df_inf['label'].astype(str).str.strip().str.lower()
+    drug = pd.Series(np.full(df_inf.shape[0], None, dtype=object), index=df_inf.index)
+    for d in vaso_labels:
+        drug[label.isin(vaso_labels[d])] = d
+    # only valid orders
+    idxKeep = drug.notnull().values & (df_inf['statusdescription'] != 'Rewritten').values
+
+    df_inf = df_inf.loc[idxKeep, :]
+    iid = df_inf['icustay_id'].values.astype(int)
+    t0 = get_hours(df_inf['icustarttime'])
+    t1 = get_hours(df_inf['icuendtime'])
+
+    # convert each rate to mcg/kg/min, dividing by the weight at the start of the infusion if needed
+    unit = df_inf['rateuom'].astype(str).str.strip().str.lower()
+    scale = unit.map(lambda u: rate_units.get(u, (np.nan, True))[0]).values.astype(float)
+    per_kg = unit.map(lambda u: rate_units.get(u, (np.nan, True))[1]).values.astype(bool)
+    rate = df_inf['rate'].values.astype(float) * scale
+    if np.any(~per_kg):
+        w = get_weights(df_weight, iid[~per_kg], t0[~per_kg], intime=intime)
+        w[np.isnan(w) | (w <= 0)] = DEFAULT_WEIGHT
+        rate[~per_kg] = rate[~per_kg] / w
+
+    df_rates = pd.DataFrame({'icustay_id': iid, 'drug': drug.values[idxKeep],
+                             'starttime': t0, 'endtime': t1, 'rate': rate},
+                            columns=['icustay_id', 'drug', 'starttime', 'endtime', 'rate'])
+    idxKeep = (df_rates['rate'] > 0) & (df_rates['endtime'] > df_rates['starttime'])
+    return df_rates.loc[idxKeep, :].reset_index(drop=True)
+
+
+def get_hourly_rates(df_rates, iid, hr):
+    # the rate of each vasopressor at the end of each hour of the grid (icustay_id, hr), as in sofa.sql:
+    # an infusion is counted in hour hr if starttime < hr <= endtime; the maximum is taken if several are
+    iid = np.asarray(iid).astype(int)
+    hr = np.asarray(hr).astype(int)
+    grid = pd.MultiIndex.from_arrays([iid, hr])
+
+    data = OrderedDict()
+    for d in vaso_labels:
+        x = np.full(iid.shape[0], np.nan)
+        df_tmp = df_rates.loc[df_rates['drug'] == d, :]
+        if df_tmp.shape[0] > 0:
+            # expand each infusion into the hours it covers, as in mp_utils.get_range_bins
+            h0 = np.floor(df_tmp['starttime'].values).astype(np.int64) + 1
+            h1 = np.floor(df_tmp['endtime'].values).astype(np.int64)
+            n = np.maximum(h1 - h0 + 1, 0)
+            h = np.repeat(h0, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+            r = np.repeat(df_tmp['rate'].values, n)
+
+            pos = grid.get_indexer(pd.MultiIndex.from_arrays([np.repeat(df_tmp['icustay_id'].values, n), h]))
+            idx = pos >= 0
+            np.fmax.at(x, pos[idx], r[idx])
+        data['rate_' + d] = x
+    return pd.DataFrame(data, columns=list(data.keys()))
+
+
+def rolling_window(x, iid, hr, W=W_SOFA, agg='max'):
+    # max or sum of x over the rows of the same stay with hours in [hr-W, hr], for data sorted by (iid, hr)
+    # missing values are ignored, and the result is missing if all values in the window are missing
+    N = x.shape[0]
+    obs = ~np.isnan(x)
+    fill = 0.0 if agg == 'sum' else -np.inf
+    fcn = np.add if agg == 'sum' else np.maximum
+    x0 = np.where(obs, x, fill)
+    y = x0.copy()
+    n = obs.astype(int)
+
+    # the row k rows earlier is in the window if it is from the same stay and within W hours
+    # as hours are distinct within a stay, no row more than W rows earlier can be in the window
+    for k in range(1, min(W, N-1) + 1):
+        idx = np.nonzero((iid[k:] == iid[:-k]) & (hr[k:] - hr[:-k] <= W))[0]
+        if idx.shape[0] == 0:
+            break
+        y[idx+k] = fcn(y[idx+k], x0[idx])
+        n[idx+k] += obs[idx]
+
+    y[n == 0] = np.nan
+    return y
+
+
+def score(conditions, scores, missing):
+    # the score of the first condition which is true, 0 if none are, and missing where missing is true
+    return np.select(list(conditions) + [missing], list(scores) + [np.nan], default=0)
+
+
+def get_sofa(df, df_rates=None, df_vent=None, W=W_SOFA):
+    # hourly SOFA components and the rolling 24 hour score for each row of mp_data (icustay_id, hr)
+    # df_rates - from get_vasopressor_rates (optional)
+    # df_vent - the vent range table (icustay_id, starttime_elapsed, endtime_elapsed), used if df has no vent column
+    #   without either, every PaO2/FiO2 ratio is treated as unventilated
+    # returns a dataframe with the same rows (and index) as df
+    with mp_instrument.timer('mp_sofa.get_sofa', rows=df.shape[0]):
+        iid = df['icustay_id'].values.astype(int)
+        hr = df['hr'].values.astype(int)
+        idxSort = np.lexsort((hr, iid))
+        iid, hr = iid[idxSort], hr[idxSort]
+
+        def get(c):
+            if c not in df.columns:
+                return np.full(iid.shape[0], np.nan)
+            return df[c].values.astype(float)[idxSort]
+
+        if df_rates is not None:
+            df_hr = get_hourly_rates(df_rates, iid, hr)
+        else:
+            df_hr = pd.DataFrame(np.full([iid.shape[0], len(vaso_labels)], np.nan),
+                                 columns=['rate_' + d for d in vaso_labels])
+        nor, epi = df_hr['rate_norepinephrine'].values, df_hr['rate_epinephrine'].values
+        dop, dob = df_hr['rate_dopamine'].values, df_hr['rate_dobutamine'].values
+
+        if 'vent' in df.columns:
+            vent = get('vent') > 0
+        elif df_vent is not None:
+            vent = mp_intervals.StayIntervals(df_vent).query(iid, hr-1, hr)[0]
+        else:
+            vent = np.zeros(iid.shape[0], dtype=bool)
+
+        pf = get('bg_pao2fio2ratio')
+        pf_vent = np.where(vent, pf, np.nan)
+        pf_novent = np.where(vent, np.nan, pf)
+        platelet = get('platelet')
+        bilirubin = get('bilirubin')
+        meanbp = get('meanbp')
+        gcs = get('gcs')
+        creatinine = get('creatinine')
+        uo = rolling_window(get('urineoutput'), iid, hr, W=W, agg='sum')
+
+        data = OrderedDict()
+        data['icustay_id'] = iid
+        data['hr'] = hr
+        for c in df_hr.columns:
+            data[c] = df_hr[c].values
+        data['urineoutput_24hours'] = uo
+
+        # each component is missing if its underlying data is missing
+        data['respiration'] = score([pf_vent < 100, pf_vent < 200, pf_novent < 300, pf_novent < 400],
+                                    [4, 3, 2, 1], np.isnan(pf))
+        data['coagulation'] = score([platelet < 20, platelet < 50, platelet < 100, platelet < 150],
+                                    [4, 3, 2, 1], np.isnan(platelet))
+        data['liver'] = score([bilirubin >= 12, bilirubin >= 6, bilirubin >= 2, bilirubin >= 1.2],
+                              [4, 3, 2, 1], np.isnan(bilirubin))
+        # as in sofa.sql, any epinephrine or norepinephrine scores at least 3
+        data['cardiovascular'] = score([(dop > 15) | (epi > 0.1) | (nor > 0.1),
+                                        (dop > 5) | (epi <= 0.1) | (nor <= 0.1),
+                                        (dop > 0) | (dob > 0),
+                                        meanbp < 70],
+                                       [4, 3, 2, 1],
+                                       np.isnan(meanbp) & np.isnan(dop) & np.isnan(dob) & np.isnan(epi) & np.isnan(nor))
+        data['cns'] = score([(gcs >= 13) & (gcs <= 14), (gcs >= 10) & (gcs <= 12), (gcs >= 6) & (gcs <= 9), gcs < 6],
+                            [1, 2, 3, 4], np.isnan(gcs))
+        data['renal'] = score([creatinine >= 5, uo < 200, creatinine >= 3.5, uo < 500,
+                               creatinine >= 2, creatinine >= 1.2],
+                              [4, 4, 3, 3, 2, 1], np.isnan(creatinine) & np.isnan(uo))
+
+        # the worst score in the last 24 hours, with missing scores treated as normal (0)
+        sofa = np.zeros(iid.shape[0])
+        for c in sofa_components:
+            data[c + '_24hours'] = np.nan_to_num(rolling_window(data[c], iid, hr, W=W, agg='max'))
+            sofa = sofa + data[c + '_24hours']
+        data['sofa_24hours'] = sofa
+
+        # return the rows in the order of df
+        idxOrig = np.empty(idxSort.shape[0], dtype=int)
+        idxOrig[idxSort] = np.arange(idxSort.shape[0])
+        df_sofa = pd.DataFrame(data, columns=list(data.keys())).iloc[idxOrig, :]
+        df_sofa.index = df.index
+        return df_sofa
+
+
+def get_sofa_at_times(df_sofa, time_dict, column='sofa_24hours'):
+    # the value of column at the last hour at or before the time of each stay in time_dict, as a series
+    # indexed by icustay_id (missing if the stay has no hours before its time)
+    df_sofa = df_sofa.sort_values(['icustay_id', 'hr'])
+    g = df_sofa['icustay_id'].values.astype(int)
+    h = df_sofa['hr'].values.astype(float)
+    iid = np.asarray(list(time_dict.keys())).astype(int)
+    t = np.asarray([time_dict[i] for i in time_dict], dtype=float)
+
+    j = mp_intervals.searchsorted_grouped(g, h, iid, t, side='right') - 1
+    idx = j >= 0
+    idx[idx] = g[j[idx]] == iid[idx]
+    x = np.full(iid.shape[0], np.nan)
+    x[idx] = df_sofa[column].values[j[idx]]
+    return pd.Series(x, index=pd.Index(iid, name='icustay_id'), name=column)
@@ -0,0 +1,189 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+import mp_instrument
+import mp_window
+
+# compact in-memory representation of the hourly data (mp_data)
+# most variables (labs, blood gases) are missing for almost every hour, so rather than a dense
+# float64 column per variable, only the observations are kept:
+#   hr/offset - the hours of each stay, i.e. the rows of mp_data
+#   pos[v]/val[v] - the row and value of each observation of variable v, sorted by row
+# a window aggregate finds the observations of a window with a binary search on pos[v],
+# so hours without an observation are never scanned
+# it can be used in place of the data frame in mp_utils.get_design_matrix and mp_utils.get_data_at_time, e.g.
+#   data = SparseHourlyData(df)
+#   df_data = mp.get_design_matrix(data, time_dict, W=8, W_extra=24)
+# or built a chunk at a time, without holding the dense data in memory:
+#   data = SparseHourlyData.from_chunks(mp_load.iter_csv('mp_data.csv'))
+# values are stored as float32 by default, so results match the dense data cast to float32
+
+
+class SparseHourlyData(object):
+    def __init__(self, df, columns=None, dtype=np.float32):
+        # columns - variables to keep (default: all numeric columns other than the identifiers)
+        if columns is None:
+            columns = [c for c in df.columns
+                       if c not in ('subject_id', 'hadm_id', 'icustay_id', 'hr')
+                       and pd.api.types.is_numeric_dtype(df[c])]
+        self.columns = list(columns)
+        self.dtype = dtype
+
+        with mp_instrument.timer('SparseHourlyData.build', rows=df.shape[0]):
+            df = mp_window.sort_data(df)
+            self.stay_iid, self.offset = mp_window.get_stay_offsets(df['icustay_id'].values.astype(int))
+            self.hr = np.asarray(df['hr'].values, dtype=np.int32)
+
+            self.pos = dict()
+            self.val = dict()
+            for v in self.columns:
+                x = np.asarray(df[v].values, dtype=float)
+                obs = np.nonzero(~np.isnan(x))[0]
+                self.pos[v] = obs.astype(np.int32)
+                self.val[v] = x[obs].astype(dtype)
+            self.build_key()
+
+    def build_key(self):
+        self.key = None
+        if self.hr.shape[0] > 0:
+            self.key = mp_window.get_window_key(self.stay_iid, self.offset, self.hr.astype(int))
+
+    @classmethod
+    def from_chunks(cls, chunks, columns=None, dtype=np.float32):
+        # builds the data from an iterable of dataframes (e.g. mp_load.iter_csv), one chunk at a time
+        # each stay must be in a single chunk
+        parts = [cls(df, columns=columns, dtype=dtype) for df in chunks]
+        if len(parts) == 0:
+            raise ValueError('No chunks to build the data from.')
+        data = parts[0]
+        if len(parts) == 1:
+            return data
+
+        stay_iid = np.concatenate([p.stay_iid for p in parts])
+        N = np.cumsum([0] + [p.hr.shape[0] for p in parts])
+        data.hr = np.concatenate([p.hr for p in parts])
+        data.offset = np.concatenate([[0]] + [p.offset[1:] + N[k] for k, p in enumerate(parts)])
+        for v in data.columns:
+            data.pos[v] = np.concatenate([p.pos[v] + N[k] for k, p in enumerate(parts)]).astype(np.int32)
+            data.val[v] = np.concatenate([p.val[v] for p in parts])
+
+        if np.any(np.diff(stay_iid) <= 0):
+            if np.unique(stay_iid).shape[0] < stay_iid.shape[0]:
+                raise ValueError('A stay is split across more than one chunk.')
+            # reorder the stays (and their rows) by icustay_id
+            idxStay = np.argsort(stay_iid, kind='mergesort')
+            L = np.diff(data.offset)
+            rows = np.concatenate([np.arange(data.offset[s], data.offset[s+1]) for s in idxStay]) \
+                if data.hr.shape[0] > 0 else np.zeros(0, dtype=int)
+            new_row = np.empty(rows.shape[0], dtype=np.int64)
+            new_row[rows] = np.arange(rows.shape[0])
+            data.hr = data.hr[rows]
+            data.offset = np.concatenate([[0], np.cumsum(L[idxStay])])
+            stay_iid = stay_iid[idxStay]
+            for v in data.columns:
+                p = new_row[data.pos[v]]
+                idxSort = np.argsort(p, kind='mergesort')
+                data.pos[v] = p[idxSort].astype(np.int32)
+                data.val[v] = data.val[v][idxSort]
+
+        data.stay_iid = stay_iid
+        data.build_key()
+        return data
+
+    def __len__(self):
+        return self.hr.shape[0]
+
+    @property
+    def nbytes(self):
+        # memory used by the arrays, for comparison with df.memory_usage().sum()
+        n = self.stay_iid.nbytes + self.offset.nbytes + self.hr.nbytes
+        if self.key is not None:
+            n += self.key[0].nbytes
+        return n + sum(self.pos[v].nbytes + self.val[v].nbytes for v in self.columns)
+
+    def get_hours(self, iid):
+        # the hours of a stay
+        s = np.searchsorted(self.stay_iid, iid)
+        if s >= self.stay_iid.shape[0] or self.stay_iid[s] != iid:
+            return np.zeros(0, dtype=int)
+        return self.hr[self.offset[s]:self.offset[s+1]].astype(int)
+
+    def to_dense(self):
+        # the data as a dataframe, as it was before conversion (with float values)
+        df = OrderedDict()
+        df['icustay_id'] = np.repeat(self.stay_iid, np.diff(self.offset))
+        df['hr'] = self.hr.astype(int)
+        for v in self.columns:
+            x = np.full(self.hr.shape[0], np.nan)
+            x[self.pos[v]] = self.val[v]
+            df[v] = x
+        return pd.DataFrame(df, columns=list(df.keys()))
+
+    def get_window_rows(self, iid, t_start, t_end):
+        if self.key is None:
+            return np.zeros(len(iid), dtype=int), np.zeros(len(iid), dtype=int)
+        return mp_window.get_window_rows(self.stay_iid, self.offset, self.hr, iid, t_start, t_end, key=self.key)
+
+    def aggregate(self, v, agg, a, b):
+        # aggregate of variable v over the rows [a, b) of each window
+        if v not in self.pos:
+            raise ValueError('{} is not in the data.'.format(v))
+        pos = self.pos[v]
+        val = self.val[v]
+
+        # the observations [i, j) of each window
+        i = np.searchsorted(pos, a, side='left')
+        j = np.searchsorted(pos, b, side='left')
+        idx = j > i
+        y = np.full(a.shape[0], np.nan)
+        if agg == 'first':
+            y[idx] = val[i[idx]]
+        elif agg == 'last':
+            y[idx] = val[j[idx]-1]
+        elif agg in ('min', 'max', 'sum'):
+            # the block only spans the observations, not every hour of the window
+            block = mp_window.get_window_block(val, i, j)
+            y = mp_window.aggregate_window_block(block, agg)
+        else:
+            raise ValueError('Unrecognized aggregate: {}'.format(agg))
+        return y
+
+    def get_window_features(self, iid, t, W=8, W_extra=24, var_list=None):
+        # the same as mp_utils.get_window_features for the sparse data
+        if var_list is None:
+            var_list = mp_window.vars_of_interest()
+        var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early = var_list[0:7]
+
+        iid = np.asarray(iid).astype(int)
+        t = np.asarray(t).astype(int)
+
+        with mp_instrument.timer('SparseHourlyData.window_rows', windows=iid.shape[0]):
+            a, b = self.get_window_rows(iid, t-W, t)
+            a_early, b_early = self.get_window_rows(iid, t-W-W_extra, t)
+
+        features = [[var_first, 'first', False], [var_first_early, 'first', True],
+                    [var_last, 'last', False], [var_last_early, 'last', True],
+                    [var_min, 'min', False], [var_max, 'max', False],
+                    [var_sum, 'sum', False]]
+
+        data = OrderedDict()
+        for var_agg, agg, early in features:
+            if var_agg is None:
+                continue
+            with mp_instrument.timer('SparseHourlyData.' + agg + ('_early' if early else ''), variables=len(var_agg)):
+                for v in var_agg:
+                    if early:
+                        x = self.aggregate(v, agg, a_early, b_early)
+                    else:
+                        x = self.aggregate(v, agg, a, b)
+                    data[v + '_' + agg + ('_early' if early else '')] = x
+
+        df_data = pd.DataFrame(data, columns=list(data.keys()))
+
+        # windows without any rows in [t-W, t] have no data for the main aggregates
+        if var_sum is not None:
+            idxEmpty = b == a
+            for v in var_sum:
+                df_data.loc[idxEmpty, v + '_sum'] = np.nan
+        return df_data, b_early > a_early
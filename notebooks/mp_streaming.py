@@ -0,0 +1,185 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+from collections import deque, OrderedDict
+import mp_utils as mp
+
+# incremental version of mp_utils.get_design_matrix for real-time use
+# rather than recomputing each window from the raw rows, every stay keeps a state
+# which is updated as each new hour of mp_data arrives
+#   *_first/_last/_min/_max/_sum use the window [t-W, t]
+#   *_first_early/_last_early use the window [t-W-W_extra, t]
+# where t is the most recent hour received for the stay
+
+class WindowState(object):
+    # running aggregates for a single variable over the last W hours
+    # obs holds the (hr, value) of non-null observations in the window, which gives first/last/sum
+    # minq/maxq are monotonic deques, so the min/max is always at the front
+    def __init__(self, W, track_min=False, track_max=False):
+        self.W = W
+        self.obs = deque()
+        self.minq = deque() if track_min else None
+        self.maxq = deque() if track_max else None
+
+    def expire(self, t):
+        # remove observations which are before the start of the window ending at t
+        t_start = t - self.W
+        while self.obs and self.obs[0][0] < t_start:
+            self.obs.popleft()
+        if self.minq is not None:
+            while self.minq and self.minq[0][0] < t_start:
+                self.minq.popleft()
+        if self.maxq is not None:
+            while self.maxq and self.maxq[0][0] < t_start:
+                self.maxq.popleft()
+
+    def update(self, hr, value):
+        # each value is added/removed from each deque at most once, so this is amortized O(1)
+        self.expire(hr)
+        if value is None or value != value:
+            return
+        self.obs.append((hr, value))
+        if self.minq is not None:
+            while self.minq and self.minq[-1][1] >= value:
+                self.minq.pop()
+            self.minq.append((hr, value))
+        if self.maxq is not None:
+            while self.maxq and self.maxq[-1][1] <= value:
+                self.maxq.pop()
+            self.maxq.append((hr, value))
+
+    def first(self):
+        return self.obs[0][1] if self.obs else np.nan
+
+    def last(self):
+        return self.obs[-1][1] if self.obs else np.nan
+
+    def min(self):
+        return self.minq[0][1] if self.minq else np.nan
+
+    def max(self):
+        return self.maxq[0][1] if self.maxq else np.nan
+
+    def sum(self):
+        # summed on request (at most W+1 values) to avoid drift from a running total
+        return float(np.sum([x[1] for x in self.obs])) if self.obs else 0.0
+
+
+class StayState(object):
+    # the window state for all variables of a single icustay_id
+    def __init__(self, icustay_id, W=8, W_extra=24, var_list=None):
+        if var_list is None:
+            var_list = mp.vars_of_interest()
+        var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early = var_list[0:7]
+
+        self.icustay_id = icustay_id
+        self.W = W
+        self.W_extra = W_extra
+        self.hr = None
+
+        # hours with a row in the data, used to know if a window is empty
+        self.rows = deque()
+
+        # the order of features follows mp_utils.get_window_features
+        self.features = [[var_first, 'first', False], [var_first_early, 'first', True],
+                         [var_last, 'last', False], [var_last_early, 'last', True],
+                         [var_min, 'min', False], [var_max, 'max', False],
+                         [var_sum, 'sum', False]]
+        self.features = [x for x in self.features if x[0] is not None]
+
+        # one state per variable and window length
+        self.state = OrderedDict()
+        for var_agg, agg, early in self.features:
+            for v in var_agg:
+                if (v, early) not in self.state:
+                    self.state[(v, early)] = WindowState(W + W_extra if early else W,
+                                                         track_min=(not early) and (v in var_min),
+                                                         track_max=(not early) and (v in var_max))
+
+        self.columns = [v + '_' + agg + ('_early' if early else '')
+                        for var_agg, agg, early in self.features for v in var_agg]
+
+    def update(self, hr, row):
+        # row is a dict (or series) mapping each variable to its value at this hour
+        # hours must arrive in order
+        if self.hr is not None and hr < self.hr:
+            raise ValueError('Data for icustay_id {} arrived out of order: hour {} after hour {}.'.format(
+                self.icustay_id, hr, self.hr))
+        self.hr = hr
+        self.rows.append(hr)
+        while self.rows[0] < hr - self.W - self.W_extra:
+            self.rows.popleft()
+
+        for (v, early), s in self.state.items():
+            s.update(hr, row.get(v, np.nan))
+
+    def get_features(self, t=None):
+        # returns the features for the window ending at the last hour received
+        # observations before it have already been dropped, so no other t can be computed
+        if t is None:
+            t = self.hr
+        elif t != self.hr:
+            raise ValueError('Features for icustay_id {} are only available at the last hour received ({}), not {}.'.format(
+                self.icustay_id, self.hr, t))
+        for s in self.state.values():
+            s.expire(t)
+        idxEmpty = not any([(r >= t - self.W) and (r <= t) for r in self.rows])
+
+        out = list()
+        for var_agg, agg, early in self.features:
+            for v in var_agg:
+                if agg == 'sum' and idxEmpty:
+                    out.append(np.nan)
+                else:
+                    out.append(getattr(self.state[(v, early)], agg)())
+        return out
+
+
+class StreamingFeatures(object):
+    # the state for every active icustay_id in the unit
+    # new data is passed to update() in the same shape as mp_data,
+    # and get_design_matrix() returns the same columns as mp_utils.get_design_matrix
+    def __init__(self, W=8, W_extra=24, var_list=None):
+        if var_list is None:
+            var_list = mp.vars_of_interest()
+        self.W = W
+        self.W_extra = W_extra
+        self.var_list = var_list
+        self.stays = OrderedDict()
+        self.columns = StayState(None, W=W, W_extra=W_extra, var_list=var_list).columns
+
+        # the variables needed by any of the aggregates
+        self.variables = list()
+        for var_agg in var_list[0:7]:
+            if var_agg is None:
+                continue
+            self.variables.extend([v for v in var_agg if v not in self.variables])
+
+    def update(self, df):
+        # df has one or more new rows: icustay_id, hr, and the variables
+        # missing variables are treated as not measured
+        variables = [v for v in self.variables if v in df.columns]
+        iid = df['icustay_id'].values
+        hr = df['hr'].values
+        X = df[variables].values.astype(float)
+
+        for i in range(X.shape[0]):
+            if iid[i] not in self.stays:
+                self.stays[iid[i]] = StayState(iid[i], W=self.W, W_extra=self.W_extra, var_list=self.var_list)
+            self.stays[iid[i]].update(hr[i], dict(zip(variables, X[i,:])))
+
+    def discharge(self, iid):
+        # stop tracking a stay, e.g. after ICU discharge
+        if iid in self.stays:
+            del self.stays[iid]
+
+    def get_design_matrix(self, iid=None):
+        # returns the features at the last hour received for each stay
+        if iid is None:
+            iid = list(self.stays.keys())
+        elif np.isscalar(iid):
+            iid = [iid]
+
+        data = [self.stays[i].get_features() for i in iid]
+        df_data = pd.DataFrame(data, columns=self.columns, index=pd.Index(iid, name='icustay_id'))
+        return df_data
@@ -3,8 +3,18 @@ import numpy as np
 import pandas as pd
 import psycopg2
 import sys
+import os
 import datetime as dt
+from collections import OrderedDict
 from sklearn import metrics
+import mp_cache
+import mp_instrument
+import mp_intervals
+import mp_index
+import mp_sparse
+import mp_window
+from mp_window import vars_of_interest, sort_data, get_stay_offsets, get_window_key, get_window_rows, \
+    get_window_block, aggregate_window_block
 import matplotlib.pyplot as plt
 
 # default colours for prettier plots
@@ -116,6 +126,63 @@ def generate_times_before_death(df, T=None, T_to_death=None, seed=None):
     windowtime_dict = df.set_index('icustay_id')['windowtime'].to_dict()
     return windowtime_dict
 
+def generate_times_array(df, seed, T=None, T_to_death=None, censor=False):
+    # vectorized version of generate_times/generate_times_before_death for many experiments
+    # seed, T, and T_to_death are either single values or lists with one value per experiment
+    # (single values are used for every experiment), and None is allowed in T/T_to_death
+    # each experiment has its own np.random.Generator stream seeded by its seed,
+    # so results do not depend on the global np.random state (or change it)
+    # df is never modified or copied, and needs the same fields as generate_times
+    # returns:
+    #   icustay_id - (n_stays,) array
+    #   windowtime - (n_experiments, n_stays) int array of the time at the end of the window
+    # the endtime (discharge/death/censor time) must not be null
+    seed = np.atleast_1d(np.asarray(seed, dtype=object))
+    T = np.atleast_1d(np.asarray(T, dtype=object))
+    T_to_death = np.atleast_1d(np.asarray(T_to_death, dtype=object))
+    E = max(seed.shape[0], T.shape[0], T_to_death.shape[0])
+    for x in [seed, T, T_to_death]:
+        if x.shape[0] not in (1, E):
+            raise ValueError('seed, T, and T_to_death must be single values or have the same length.')
+
+    seed = np.broadcast_to(seed, [E])
+    # None becomes NaN, so these can be broadcast against the stays
+    T = np.broadcast_to(np.array([np.nan if x is None else x for x in T], dtype=float), [E])[:,np.newaxis]
+    T_to_death = np.broadcast_to(np.array([np.nan if x is None else x for x in T_to_death], dtype=float), [E])[:,np.newaxis]
+
+    iid = df['icustay_id'].values
+    dischtime = df['dischtime_hours'].values.astype(float)
+    deathtime = df['deathtime_hours'].values.astype(float)
+
+    # create endtime: this is the last allowable time for our window
+    # if they die before discharge, set the end time to the time of death
+    endtime = np.where(deathtime < dischtime, deathtime, dischtime)
+
+    # optionally censor the data, e.g. the first time a patient was made DNR
+    if censor:
+        censortime = df['censortime_hours'].values.astype(float)
+        endtime = np.where(censortime < endtime, censortime, endtime)
+
+    # one random stream per experiment
+    tau = np.zeros([E, iid.shape[0]])
+    for e in range(E):
+        if seed[e] is None:
+            raise ValueError('A seed must be given for every experiment.')
+        tau[e,:] = np.random.default_rng(seed[e]).random(iid.shape[0])
+
+    # extract window at least T hours before discharge/death
+    # if the stay is shorter than T hours, the window time is set to 0
+    windowtime = np.where(np.isnan(T),
+                          np.floor(tau*endtime),
+                          np.maximum(np.floor(tau*(endtime - np.nan_to_num(T))), 0))
+
+    # fix the time for those who die to be T_to_death hours from death
+    idxInICU = (deathtime - dischtime) <= T_to_death
+    windowtime = np.where(idxInICU, deathtime - T_to_death, windowtime)
+
+    return iid, windowtime.astype(int)
+
+
 # pretty confusion matrices!
 def print_cm(y, yhat):
     print('\nConfusion matrix')
@@ -132,58 +199,6 @@ def print_cm(y, yhat):
     print('   \t{:2.2f}\t{:2.2f}\t Acc={:2.2f}').format(100.0*TN / (TN+FN), 100.0*TP / (TP+FP), 100.0*(TP+TN)/N)
     print('   \tNPV\tPPV')
 
-# these define 5 lists of variable names
-# these are the variables later used for prediction
-def vars_of_interest():
-    # we extract the min/max for these covariates
-    var_min = ['heartrate', 'sysbp', 'diasbp', 'meanbp',
-                'resprate', 'tempc', 'spo2']
-    var_max = var_min
-    var_min.append('gcs')
-    #var_max.extend(['rrt','vasopressor','vent'])
-
-    # we extract the first/last value for these covariates
-    var_first = ['heartrate', 'sysbp', 'diasbp', 'meanbp',
-                'resprate', 'tempc', 'spo2']
-
-    var_last = var_first
-    var_last.extend(['gcsmotor','gcsverbal','gcseyes','endotrachflag','gcs'])
-
-    var_first_early = ['bg_po2', 'bg_pco2', #'bg_so2'
-            #'bg_fio2_chartevents', 'bg_aado2_calc',
-            #'bg_fio2', 'bg_aado2',
-            'bg_pao2fio2ratio', 'bg_ph', 'bg_baseexcess', #'bg_bicarbonate',
-            'bg_totalco2', #'bg_hematocrit', 'bg_hemoglobin',
-            'bg_carboxyhemoglobin', 'bg_methemoglobin',
-            #'bg_chloride', 'bg_calcium', 'bg_temperature',
-            #'bg_potassium', 'bg_sodium', 'bg_lactate',
-            #'bg_glucose',
-            # 'bg_tidalvolume', 'bg_intubated', 'bg_ventilationrate', 'bg_ventilator',
-            # 'bg_peep', 'bg_o2flow', 'bg_requiredo2',
-            # begin lab values
-            'aniongap', 'albumin', 'bands', 'bicarbonate', 'bilirubin', 'creatinine',
-            'chloride', 'glucose', 'hematocrit', 'hemoglobin', 'lactate', 'platelet',
-            'potassium', 'ptt', 'inr', 'sodium', 'bun', 'wbc']
-
-    var_last_early = var_first_early
-    # fourth set of variables
-    # we have special rules for these...
-    var_sum = ['urineoutput']
-
-    var_static = [u'is_male', u'emergency_admission', u'age',
-               # services
-               u'service_any_noncard_surg',
-               u'service_any_card_surg',
-               u'service_cmed',
-               u'service_traum',
-               u'service_nmed',
-               # ethnicities
-               u'race_black',u'race_hispanic',u'race_asian',u'race_other',
-               # demographics
-               u'height', u'weight', u'bmi']
-
-    return var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early, var_static
-
 
 def vars_of_interest_streaming():
     # define the covariates to be used in the model
@@ -223,7 +238,82 @@ def vars_of_interest_streaming():
     return var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early
 
 
-def get_design_matrix(df, time_dict, W=8, W_extra=24):
+def get_window_features(df, iid, t, W=8, W_extra=24, var_list=None):
+    # computes the windowed features for each (iid, t) pair
+    # returns a dataframe with one row per window, in the order requested,
+    # and a boolean vector indicating windows which contained at least one row
+    #   *_first/_last/_min/_max/_sum use the window [t-W, t]
+    #   *_first_early/_last_early use the window [t-W-W_extra, t]
+    # df can also be an mp_index.WindowIndex of precomputed aggregates,
+    # or an mp_sparse.SparseHourlyData of the observed values only
+    if isinstance(df, (mp_index.WindowIndex, mp_sparse.SparseHourlyData)):
+        return df.get_window_features(iid, t, W=W, W_extra=W_extra, var_list=var_list)
+
+    if var_list is None:
+        var_list = vars_of_interest()
+    var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early = var_list[0:7]
+
+    iid = np.asarray(iid).astype(int)
+    t = np.asarray(t).astype(int)
+
+    with mp_instrument.timer('get_design_matrix.sort', rows=df.shape[0]):
+        df = sort_data(df)
+        stay_iid, offset = get_stay_offsets(df['icustay_id'].values)
+        hr = df['hr'].values
+
+    with mp_instrument.timer('get_design_matrix.window_rows', windows=iid.shape[0]) as rec:
+        a, b = get_window_rows(stay_iid, offset, hr, iid, t-W, t)
+        a_early, b_early = get_window_rows(stay_iid, offset, hr, iid, t-W-W_extra, t)
+        rec['window_rows'] = int(np.sum(b_early - a_early))
+
+    # group the aggregates by column, so each column's window block is only gathered once
+    # the order of features follows the previous concatenation of groupby results
+    features = [[var_first, 'first', False], [var_first_early, 'first', True],
+                [var_last, 'last', False], [var_last_early, 'last', True],
+                [var_min, 'min', False], [var_max, 'max', False],
+                [var_sum, 'sum', False]]
+
+    block = dict()
+    data = OrderedDict()
+    for var_agg, agg, early in features:
+        if var_agg is None:
+            continue
+        stage = 'get_design_matrix.' + agg + ('_early' if early else '')
+        with mp_instrument.timer(stage, variables=len(var_agg)):
+            for v in var_agg:
+                if (v, early) not in block:
+                    if early:
+                        x = get_window_block(df[v].values, a_early, b_early)
+                    else:
+                        x = get_window_block(df[v].values, a, b)
+                    block[(v, early)] = [x, ~np.isnan(x)]
+                x, notnull = block[(v, early)]
+                data[v + '_' + agg + ('_early' if early else '')] = aggregate_window_block(x, agg, notnull=notnull)
+
+    with mp_instrument.timer('get_design_matrix.assemble', columns=len(data)):
+        df_data = pd.DataFrame(data, columns=list(data.keys()))
+
+        # windows without any rows in [t-W, t] have no data for the main aggregates
+        if var_sum is not None:
+            idxEmpty = b == a
+            for v in var_sum:
+                df_data.loc[idxEmpty, v + '_sum'] = np.nan
+
+    return df_data, b_early > a_early
+
+
+def get_time_array(time_dict, iid=None):
+    # converts window times into an (N, 2) int array of [icustay_id, windowtime]
+    if isinstance(time_dict, dict):
+        tmp = np.asarray(list(time_dict.items())).astype(int)
+        return np.reshape(tmp, [-1, 2])
+
+    if iid is None:
+        raise ValueError('iid must be provided when the window times are not a dictionary.')
+    return np.column_stack([np.asarray(iid).astype(int), np.asarray(time_dict).astype(int)])
+
+
+def get_design_matrix(df, time_dict, W=8, W_extra=24, iid=None, df_range=None):
     # W_extra is the number of extra hours to look backward for labs
     # e.g. if W_extra=24 we look back an extra 24 hours for lab values
 
@@ -233,62 +323,133 @@ def get_design_matrix(df, time_dict, W=8, W_extra=24):
     # timing info for all icustay_id:
     #   5 loops, best of 3: 1.48 s per loop
 
-    # get the hardcoded variable names
-    var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early, var_static = vars_of_interest()
-
-    tmp = np.asarray(time_dict.items()).astype(int)
-    N = tmp.shape[0]
+    # the data is sorted once by (icustay_id, hr), and each window is located
+    # with a binary search on the per-stay row offsets, rather than merging
+    # a tiled time grid with the data and running a groupby per aggregate
 
-    M = W+W_extra
-    # create a vector of [0,...,M] to represent the hours we need to subtract for each icustay_id
-    hr = np.linspace(0,M,M+1,dtype=int)
-    hr = np.reshape(hr,[1,M+1])
-    hr = np.tile(hr,[N,1])
-    hr = np.reshape(hr, [N*(M+1),], order='F')
+    # time_dict is either a dictionary of {icustay_id: windowtime}, or an array of window
+    # times with the corresponding icustay_id in iid (e.g. one row from generate_times_array)
 
-    # duplicate tmp to M+1, as we will be creating T+1 rows for each icustay_id
-    tmp = np.tile(tmp,[M+1,1])
+    # df_range is an optional dictionary of range signal tables, e.g. {'vent': df_vent},
+    # with each table either a dataframe of ranges or an mp_intervals.StayIntervals
+    # *_any, *_all, and *_hours columns for the window [t-W, t] are added for each table
 
-    tmp_early_flag = np.copy(tmp[:,1])
+    # get the hardcoded variable names
+    var_list = vars_of_interest()
 
-    # adding hr to tmp[:,1] gives us what we want: integers in the range [Tn-T, Tn]
-    tmp = np.column_stack([tmp[:,0], tmp[:,1]-hr, hr>W])
+    tmp = get_time_array(time_dict, iid=iid)
 
-    # create dataframe with tmp
-    df_time = pd.DataFrame(data=tmp, index=None, columns=['icustay_id','hr','early_flag'])
-    df_time.sort_values(['icustay_id','hr'],inplace=True)
+    # sort by icustay_id, as groupby would have done
+    tmp = tmp[np.argsort(tmp[:,0], kind='mergesort'),:]
 
-    # merge df_time with df to filter down to a subset of rows
-    df = df.merge(df_time, left_on=['icustay_id','hr'], right_on=['icustay_id','hr'],how='inner')
+    df_data, idxKeep = get_window_features(df, tmp[:,0], tmp[:,1], W=W, W_extra=W_extra, var_list=var_list)
 
-    # apply functions to groups of vars
-    df_first_early  = df.groupby('icustay_id')[var_first_early].first()
-    df_last_early   = df.groupby('icustay_id')[var_last_early].last()
+    if df_range is not None:
+        for f in df_range:
+            with mp_instrument.timer('get_design_matrix.' + f, windows=tmp.shape[0]):
+                intervals = df_range[f]
+                if not isinstance(intervals, mp_intervals.StayIntervals):
+                    intervals = mp_intervals.StayIntervals(intervals)
+                df_tmp = intervals.get_features(tmp[:,0], tmp[:,1], W=W,
+                                                name=mp_intervals.range_names.get(f, f))
+                for c in df_tmp.columns:
+                    df_data[c] = df_tmp[c].values
 
+    # only icustay_id with data in the window are returned
+    df_data.index = pd.Index(tmp[:,0], name='icustay_id')
+    df_data = df_data.loc[idxKeep,:]
 
-    # slice down df_time by removing early times
-    # isolate only have data from [t - W, t - W + 1, ..., t]
-    df = df.loc[df['early_flag']==0,:]
+    return df_data
 
-    df_first = df.groupby('icustay_id')[var_first].first()
-    df_last  = df.groupby('icustay_id')[var_last].last()
-    df_min = df.groupby('icustay_id')[var_min].min()
-    df_max = df.groupby('icustay_id')[var_max].max()
-    df_sum = df.groupby('icustay_id')[var_sum].sum()
+# cache of the design matrices from get_design_matrix_cached, created when first used
+# its entries are named so they cannot be confused with the csv entries of mp_cache.read_csv_cached
+design_matrix_cache = None
+
+# modules whose source is part of the key of a cached design matrix
+design_matrix_modules = [mp_window, mp_intervals, mp_index, mp_sparse]
+
+
+def get_design_matrix_cache():
+    global design_matrix_cache
+    if design_matrix_cache is None:
+        design_matrix_cache = mp_cache.FrameCache('memo_design_matrix')
+    return design_matrix_cache
+
+
+def get_design_matrix_cached(df, time_dict, W=8, W_extra=24, iid=None, df_range=None, version=None, cache=None):
+    # memoised get_design_matrix - repeated calls with the same inputs, in this session or
+    # (from the disk cache) a later one, return the stored design matrix rather than recomputing it
+    # the entry is keyed by a hash of:
+    #   the data: version if given (e.g. the data_ext and path of the source files),
+    #     otherwise a hash of the content of df (see mp_cache.data_version)
+    #   the window times, W, W_extra, the variables from vars_of_interest, and the range tables
+    #   the source of this file and design_matrix_modules, so changes to the feature extraction invalidate the cache
+    # cache is an mp_cache.FrameCache (default: one shared cache, stored in mp_cache.CACHE_DIR)
+    if cache is None:
+        cache = get_design_matrix_cache()
+
+    with mp_instrument.timer('get_design_matrix_cached') as rec:
+        if version is None:
+            version = mp_cache.data_version(df)
+        ranges = None
+        if df_range is not None:
+            ranges = [[f, mp_cache.data_version(df_range[f])] for f in df_range]
+        sources = [os.path.abspath(__file__)] + [os.path.abspath(m.__file__) for m in design_matrix_modules]
+        key = mp_cache.hash_key([version,
+                                 mp_cache.hash_content(get_time_array(time_dict, iid=iid)),
+                                 W, W_extra,
+                                 mp_cache.hash_content(vars_of_interest()),
+                                 ranges,
+                                 [mp_cache.file_signature(f, content=True) for f in sources]])
+
+        df_data = cache.get(key)
+        rec['hit'] = int(df_data is not None)
+        if df_data is None:
+            df_data = get_design_matrix(df, time_dict, W=W, W_extra=W_extra, iid=iid, df_range=df_range)
+            cache.put(key, df_data)
+    return df_data
 
-    # update the column names
-    df_first.columns = [x + '_first' for x in df_first.columns]
-    df_last.columns = [x + '_last' for x in df_last.columns]
-    df_first_early.columns = [x + '_first_early' for x in df_first_early.columns]
-    df_last_early.columns = [x + '_last_early' for x in df_last_early.columns]
-    df_min.columns = [x + '_min' for x in df_min.columns]
-    df_max.columns = [x + '_max' for x in df_max.columns]
-    df_sum.columns = [x + '_sum' for x in df_sum.columns]
 
-    # now combine all the arrays together
-    df_data = pd.concat([df_first, df_first_early, df_last, df_last_early, df_min, df_max, df_sum], axis=1)
+def get_design_matrix_chunked(chunks, time_dict, filename, W=8, W_extra=24, iid=None, df_range=None):
+    # out-of-core version of get_design_matrix for data which does not fit in memory
+    # chunks is an iterable of dataframes, each holding all the rows of a set of stays,
+    # e.g. mp_load.iter_mp_data, mp_load.iter_csv, or mp_load.iter_parquet
+    # the design matrix of each chunk is computed independently and appended to the csv filename,
+    # so only one chunk (and its windows) is in memory at a time
+    # if the chunks are in order of icustay_id, the file is identical to writing get_design_matrix
+    # for the full data with .to_csv(filename)
+    # returns the number of rows written
+    tmp = get_time_array(time_dict, iid=iid)
+    tmp = tmp[np.argsort(tmp[:,0], kind='mergesort'),:]
+
+    # the interval index of each range table is built once, rather than for every chunk
+    if df_range is not None:
+        df_range = OrderedDict([[f, df_range[f] if isinstance(df_range[f], mp_intervals.StayIntervals)
+                                 else mp_intervals.StayIntervals(df_range[f])] for f in df_range])
+
+    N = 0
+    header = True
+    with open(filename, 'w') as fp:
+        for df in chunks:
+            # windows for the stays in this chunk
+            idx = np.isin(tmp[:,0], df['icustay_id'].values)
+            if not np.any(idx):
+                continue
+
+            with mp_instrument.timer('get_design_matrix_chunked.chunk', rows=df.shape[0]) as rec:
+                df_data = get_design_matrix(df, tmp[idx,1], W=W, W_extra=W_extra, iid=tmp[idx,0],
+                                            df_range=df_range)
+                df_data.to_csv(fp, header=header)
+                rec['windows'] = df_data.shape[0]
+
+            header = False
+            N += df_data.shape[0]
+
+    if header:
+        # no windows had data
+        pd.DataFrame(index=pd.Index([], name='icustay_id')).to_csv(filename)
+    return N
 
-    return df_data
 
 # this function is used to print out data for a single pt
 # mainly used for debugging weird inconsistencies in data extraction
@@ -337,43 +498,113 @@ def debug_for_iid(df, time_dict, iid, T=8, W_extra=24):
     display(HTML(df_tmp.groupby('icustay_id')[var_first].last().to_html().replace('NaN','')))
 
 
-def collapse_data(data):
+def get_range_bins(df, step=1):
+    # expands a range table into the (icustay_id, hour) bins which each range overlaps
+    # the hour bins are [k*step, (k+1)*step), and ranges are [starttime_elapsed, endtime_elapsed]
+    iid = df['icustay_id'].values
+    b0 = np.floor(df['starttime_elapsed'].values / step).astype(np.int64)
+    b1 = np.floor(df['endtime_elapsed'].values / step).astype(np.int64)
+    n = np.maximum(b1 - b0 + 1, 0)
+
+    # vectorised arange for each range: repeat the start, then add 0, 1, ..., n-1 within each range
+    idx = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    return np.repeat(iid, n), np.repeat(b0, n) + idx
+
+
+def collapse_data(data, step=1):
     # this collapses a dictionary of dataframes into a single dataframe
     # joins them together on icustay_id and charttime
-    files = data.keys()
-    initFlag = False # tells the function to create a new dataframe
+    # all sources are aligned on the sorted union of (icustay_id, charttime_elapsed) in one pass:
+    # the union of keys is sorted once, then each source's columns are written into
+    # pre-allocated arrays at the position of their keys, rather than chaining outer merges
+    # if a source has more than one row for the same key, the last row is kept
+    #
+    # range tables have icustay_id, starttime_elapsed and endtime_elapsed (same units as charttime_elapsed)
+    # and are expanded into an indicator per hour (step is the length of an hour in these units):
+    # it is 1 if any range overlaps the hour bin of the row, 0 otherwise
+    # rows are added for each hour a range covers
 
     # dictionary mapping table names to column name of interest
     colNameMap = {'vent': 'vent',
                   'vasopressor': 'vasopressor',
                   'rrt_range': 'rrt'}
     rangeTbl = ['vent','vasopressor','rrt_range']
+    dropCols = ['subject_id', 'hadm_id', 'storetime', 'icustay_id', 'charttime_elapsed']
 
-    # merge all data from above dictionary into a single data frame
-    for i, f in enumerate(files):
+    # gather the keys of all sources
+    iid_list, t_list, n_list = list(), list(), list()
+    bins = dict()
+    for f in data:
         df_tmp = data[f]
-
-        if 'subject_id' in df_tmp.columns:
-            df_tmp.drop('subject_id',axis=1,inplace=True)
-        if 'hadm_id' in df_tmp.columns:
-            df_tmp.drop('hadm_id',axis=1,inplace=True)
-        if 'storetime' in df_tmp.columns:
-            df_tmp.drop('storetime',axis=1,inplace=True)
-
-        print('{:20s}... finished.'.format(f))
         if f in rangeTbl:
-            continue # these are rangesignal tables.. need to be handled separately
-
-        if initFlag == False:
-            df = df_tmp.copy()
-            initFlag = True
-            continue
+            bins[f] = get_range_bins(df_tmp, step=step)
+            iid_list.append(bins[f][0])
+            t_list.append(bins[f][1] * step)
         else:
-            df = df.merge(df_tmp,
-                            on=['icustay_id','charttime_elapsed'],
-                            how='outer')
-
-        return df
+            iid_list.append(df_tmp['icustay_id'].values)
+            t_list.append(df_tmp['charttime_elapsed'].values)
+        n_list.append(iid_list[-1].shape[0])
+
+    if len(iid_list) == 0:
+        return pd.DataFrame(columns=['icustay_id', 'charttime_elapsed'])
+
+    # sort the union of keys once, and map every source row to its position in the unique keys
+    iid = np.concatenate(iid_list)
+    t = np.concatenate(t_list)
+    idxSort = np.lexsort((t, iid))
+    iid = iid[idxSort]
+    t = t[idxSort]
+    idxNew = np.ones(iid.shape[0], dtype=bool)
+    idxNew[1:] = (iid[1:] != iid[:-1]) | (t[1:] != t[:-1])
+    pos = np.empty(iid.shape[0], dtype=np.int64)
+    pos[idxSort] = np.cumsum(idxNew) - 1
+    iid = iid[idxNew]
+    t = t[idxNew]
+    N = iid.shape[0]
+
+    columns = OrderedDict([['icustay_id', iid], ['charttime_elapsed', t]])
+    offset = np.cumsum([0] + n_list)
+
+    # the hour bin of each key, as a composite integer with the stay, for range table lookups
+    if len(bins) > 0:
+        stays = np.unique(iid)
+        bin_all = np.floor(t / step).astype(np.int64)
+        bin_min = bin_all.min()
+        span = np.int64(bin_all.max() - bin_min + 1)
+        key = np.searchsorted(stays, iid).astype(np.int64) * span + (bin_all - bin_min)
+
+    for i, f in enumerate(data):
+        with mp_instrument.timer('collapse_data.' + f, rows=n_list[i]):
+            df_tmp = data[f]
+            if f in rangeTbl:
+                iid_rng, bin_rng = bins[f]
+                key_rng = np.unique(np.searchsorted(stays, iid_rng).astype(np.int64) * span + (bin_rng - bin_min))
+                idx = np.minimum(np.searchsorted(key_rng, key), max(key_rng.shape[0] - 1, 0))
+                x = np.zeros(N)
+                if key_rng.shape[0] > 0:
+                    x[key_rng[idx] == key] = 1
+                columns[colNameMap[f]] = x
+            else:
+                pos_f = pos[offset[i]:offset[i+1]]
+                for c in df_tmp.columns:
+                    if c in dropCols:
+                        continue
+                    x = df_tmp[c].values
+                    if x.dtype.kind in 'biuf':
+                        x_all = np.full(N, np.nan)
+                    elif x.dtype.kind in 'mM':
+                        x_all = np.full(N, np.datetime64('NaT') if x.dtype.kind == 'M' else np.timedelta64('NaT'), dtype=x.dtype)
+                    else:
+                        x_all = np.full(N, np.nan, dtype=object)
+                    x_all[pos_f] = x
+
+                    # the same column in more than one source is suffixed with the table name
+                    if c in columns:
+                        c = c + '_' + f
+                    columns[c] = x_all
+
+    mp_instrument.count('collapse_data', rows=N, sources=len(n_list))
+    return pd.DataFrame(columns)
 
 
 def plot_xgb_importance_fmap(xgb_model, X_header=None, ax=None, height=0.2,
@@ -500,11 +731,18 @@ def plot_model_results(results, pretty_labels=None):
     #plt.legend(loc='lower right',fontsize=18)
     plt.show()
 
-def load_design_matrix(co, df_additional_data=None, data_ext='', path=None, diedWithin=None):
+def load_design_matrix(co, df_additional_data=None, data_ext='', path=None, diedWithin=None, cache_dir=None,
+                       columns=None, dtype=float, mmap=None):
     # this function loads in the data from csv
     # co is a dataframe with:
     #    - patients to include (all the icustay_ids in the index)
     #    - the outcome (first and only column)
+    # if cache_dir is given, the parsed csv files are cached there (see mp_cache)
+    # and later calls memory-map the cached columns instead of re-reading the csv
+    # columns is an optional list of the features to return (from the design matrix or
+    # df_additional_data), in that order - other columns are not read
+    # X is a single C-contiguous array of the given dtype (e.g. np.float32), filled one column at a time
+    # if mmap is a filename, X is a memory-mapped .npy file written there instead of an array in memory
 
     if path is None:
         path = ''
@@ -512,91 +750,187 @@ def load_design_matrix(co, df_additional_data=None, data_ext='', path=None, died
     if data_ext != '' and data_ext[0] != '_':
         data_ext = '_' + data_ext
 
-    df_offset = pd.read_csv(path + 'icustays_offset' + data_ext + '.csv')
-    df_offset['intime'] = pd.to_datetime(df_offset['intime'])
-    df_offset['outtime'] = pd.to_datetime(df_offset['outtime'])
-    df_offset['deathtime'] = pd.to_datetime(df_offset['deathtime'])
-    df_offset['icustay_id'] = df_offset['icustay_id'].astype(int)
-    df_offset = df_offset.loc[:,['icustay_id','intime','outtime','starttime','deathtime']]
-    df_offset.set_index('icustay_id',inplace=True)
+    # HACK: drop some variables here we are not interested in
+    # they should be removed from vars_of_interest and data extraction re-run
+    # the treatment ranges are instead given by the *_any, *_all, *_hours columns
+    # from get_design_matrix(..., df_range=...), which are kept
+    vars_to_delete = ['bg_intubated_first', 'bg_ventilationrate_first', 'bg_ventilator_first',
+    'bg_intubated_last', 'bg_ventilationrate_last', 'bg_ventilator_last',
+    'rrt_min', 'vasopressor_min', 'vent_min',
+    'rrt_max', 'vasopressor_max', 'vent_max']
 
     # load in the design matrix
-    df_design = pd.read_csv(path + 'design_matrix' + data_ext + '.csv')
-    df_design['icustay_id'] = df_design['icustay_id'].astype(int)
-    df_design.set_index('icustay_id',inplace=True)
+    fn = path + 'design_matrix' + data_ext + '.csv'
+    with mp_instrument.timer('load_design_matrix.read_design', bytes=os.path.getsize(fn), cached=cache_dir is not None) as rec:
+        if cache_dir is None:
+            if columns is None:
+                df_design = pd.read_csv(fn)
+            else:
+                df_design = pd.read_csv(fn, usecols=lambda c: c == 'icustay_id' or c in columns)
+        else:
+            df_design = mp_cache.read_csv_cached(fn, key=data_ext, cache_dir=cache_dir)
+        rec['rows'] = df_design.shape[0]
+    df_design.index = pd.Index(df_design['icustay_id'].values.astype(int), name='icustay_id')
+
+    # the source of each feature: the design matrix, then the static vars
+    sources = OrderedDict()
+    for c in df_design.columns:
+        if c != 'icustay_id' and c not in vars_to_delete:
+            sources[c] = df_design
+    if df_additional_data is not None:
+        for c in df_additional_data.columns:
+            if c not in vars_to_delete:
+                sources[c] = df_additional_data
 
+    if columns is None:
+        X_header = list(sources.keys())
+    else:
+        missing = [c for c in columns if c not in sources]
+        if len(missing) > 0:
+            raise ValueError('Columns not found in the design matrix: {}'.format(', '.join(missing)))
+        X_header = list(columns)
+
+    # rows of each source for the icustay_id in co, as a left join would give (-1 if missing)
+    icustay_id = co.index.values
+    idxRow = dict()
+    idxFound = dict()
+    for src in [df_design, df_additional_data]:
+        if src is not None:
+            idxRow[id(src)] = src.index.get_indexer(icustay_id)
+            idxFound[id(src)] = np.all(idxRow[id(src)] >= 0)
+
+    if mmap is None:
+        X = np.empty([icustay_id.shape[0], len(X_header)], dtype=dtype)
+    else:
+        X = np.lib.format.open_memmap(mmap, mode='w+', dtype=dtype, shape=(icustay_id.shape[0], len(X_header)))
 
-    # join these dfs together, add in the static vars
-    df = co.merge(df_design, how='left', left_index=True, right_index=True)
-    if df_additional_data is not None:
-        df = df.merge(df_additional_data,how='left', left_index=True, right_index=True)
+    with mp_instrument.timer('load_design_matrix.fill', columns=len(X_header), rows=icustay_id.shape[0]):
+        for j, c in enumerate(X_header):
+            src = sources[c]
+            idx = idxRow[id(src)]
+            x = np.asarray(src[c].values, dtype=float)
+            if idxFound[id(src)]:
+                X[:,j] = x[idx]
+            else:
+                X[:,j] = np.where(idx >= 0, x[np.maximum(idx, 0)] if x.shape[0] > 0 else np.nan, np.nan)
+
+    y = co.iloc[:,0].values.astype(float)
 
     # change y to be "died within X seconds", where X is specified by the user
+    # diedWithin can be a list of horizons, in which case y is a matrix with a column for each
     if diedWithin is not None:
-        df = df.merge(df_offset[['intime','deathtime','starttime']],
-        how='left', left_index=True, right_index=True)
+        df_offset = load_offsets(data_ext=data_ext, path=path, cache_dir=cache_dir)
+        death_offset = get_death_offsets(df_offset, icustay_id)
+        y = get_outcome_labels(death_offset, diedWithin)
+        if np.ndim(diedWithin) == 0:
+            y = y[:,0].astype(float)
 
-        df['hospital_expire_flag'] = np.zeros(df.shape[0],dtype=int)
-        idxUpdate = ~df['deathtime'].isnull()
-        df.loc[idxUpdate,'hospital_expire_flag'] = (df.loc[idxUpdate,'deathtime'] <
-                                                        (df.loc[idxUpdate,'intime']
-                                                         + pd.to_timedelta(df.loc[idxUpdate,'starttime'], 's')
-                                                         + np.timedelta64(diedWithin, 's')))
+    return X, y, X_header
 
-        # drop the columns temporarily added to redefine the outcome
-        df.drop('intime',axis=1,inplace=True)
-        df.drop('starttime',axis=1,inplace=True)
-        df.drop('deathtime',axis=1,inplace=True)
 
-    # HACK: drop some variables here we are not interested in
-    # they should be removed from vars_of_interest and data extraction re-run
-    vars_to_delete = ['bg_intubated_first', 'bg_ventilationrate_first', 'bg_ventilator_first',
-    'bg_intubated_last', 'bg_ventilationrate_last', 'bg_ventilator_last',
-    'rrt_min', 'vasopressor_min', 'vent_min',
-    'rrt_max', 'vasopressor_max', 'vent_max']
-    for v in vars_to_delete:
-        if v in df.columns:
-            df.drop(v, axis=1, inplace=True)
+def load_offsets(data_ext='', path=None, cache_dir=None):
+    # loads the icustays_offset file written with the design matrix, indexed by icustay_id
+    if path is None:
+        path = ''
 
-    # move from a data frame into a numpy array
-    X = df.values.astype(float)
-    y = X[:,0]
+    if data_ext != '' and data_ext[0] != '_':
+        data_ext = '_' + data_ext
 
-    icustay_id = df.index.values
+    fn = path + 'icustays_offset' + data_ext + '.csv'
+    with mp_instrument.timer('load_design_matrix.read_offset', bytes=os.path.getsize(fn), cached=cache_dir is not None) as rec:
+        if cache_dir is None:
+            df_offset = pd.read_csv(fn)
+            df_offset['intime'] = pd.to_datetime(df_offset['intime'])
+            df_offset['outtime'] = pd.to_datetime(df_offset['outtime'])
+            df_offset['deathtime'] = pd.to_datetime(df_offset['deathtime'])
+        else:
+            df_offset = mp_cache.read_csv_cached(fn, parse_dates=['intime','outtime','deathtime'],
+                                                 key=data_ext, cache_dir=cache_dir)
+        rec['rows'] = df_offset.shape[0]
+    df_offset['icustay_id'] = df_offset['icustay_id'].astype(int)
+    df_offset = df_offset.loc[:,['icustay_id','intime','outtime','starttime','deathtime']]
+    df_offset.set_index('icustay_id',inplace=True)
+    return df_offset
 
-    # delete first column: the outcome
-    X = np.delete(X,0,axis=1)
 
-    # get a header row
-    X_header = [xval for x, xval in enumerate(df.columns) if x > 0]
+def get_death_offsets(df_offset, iid):
+    # seconds from the start of the window (intime + starttime) to death for each icustay_id in iid
+    # the offsets are floored to whole seconds, which gives the same labels for integer horizons
+    # stays without a death (or without times) are given the largest int64 so they are never labelled
+    df_offset = df_offset.reindex(iid)
+    intime = df_offset['intime'].values.astype('datetime64[ns]')
+    deathtime = df_offset['deathtime'].values.astype('datetime64[ns]')
+    starttime = df_offset['starttime'].values.astype(float)
 
-    return X, y, X_header
+    idxValid = ~np.isnat(intime) & ~np.isnat(deathtime) & ~np.isnan(starttime)
+    offset = np.full(iid.shape[0], np.iinfo(np.int64).max, dtype=np.int64)
+    delta = (deathtime[idxValid] - intime[idxValid]).astype('timedelta64[ns]').astype(np.int64)
+    offset[idxValid] = np.floor(delta / 1e9 - starttime[idxValid]).astype(np.int64)
+    return offset
 
-def get_predictions(df, df_static,  mdl, iid):
-    df = df.loc[df['icustay_id']==iid,:]
+
+def get_outcome_labels(death_offset, diedWithin):
+    # labels for "died within X seconds" for each horizon X in diedWithin
+    # returns an (n_stays, n_horizons) int array
+    horizons = np.atleast_1d(np.asarray(diedWithin, dtype=np.int64))
+    return (death_offset[:,np.newaxis] < horizons[np.newaxis,:]).astype(int)
+
+
+def get_design_matrix_at_times(df, df_static, iid, tm, W=4, W_extra=24):
+    # builds the design matrix, including static variables, for every (iid, tm) pair
+    # this is done in one pass, so it can be used to create a row for every hour of a stay
+    # returns a numpy array with one row per pair, in the order requested
+    var_list = vars_of_interest()
+    var_static = var_list[7]
+
+    iid = np.asarray(iid).astype(int)
+    tm = np.asarray(tm).astype(int)
+
+    df_data, idxKeep = get_window_features(df, iid, tm, W=W, W_extra=W_extra, var_list=var_list)
+
+    # add the data from static vars from df_static
+    X_static = df_static.set_index('icustay_id')[var_static].reindex(iid).values.astype(float)
+
+    X = np.column_stack([df_data.values, X_static])
+    return X
+
+
+def get_predictions_batch(df, df_static, mdl, iid, W=4, W_extra=24):
+    # scores every hour of one or many stays with a single call to predict_proba
+    # returns the icustay_id, hour, and probability of each prediction
+    if np.isscalar(iid):
+        iid = [iid]
+    df = df.loc[df['icustay_id'].isin(iid),:]
+    df = sort_data(df)
+
+    iid_all = df['icustay_id'].values
     tm = df['hr'].values
-    prob = list()
-    var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early, var_static = vars_of_interest()
 
-    for t in tm:
-        time_dict = {iid: t}
-        X = get_design_matrix(df, time_dict, W=4, W_extra=24)
+    X = get_design_matrix_at_times(df, df_static, iid_all, tm, W=W, W_extra=W_extra)
+    prob = mdl.predict_proba(X)[:,1]
 
-        # first, the data from static vars from df_static
-        X = X.merge(df_static.set_index('icustay_id')[var_static], how='left', left_index=True, right_index=True)
+    return iid_all, tm, prob
 
-        # convert to numpy data
-        X = X.values
 
-        curr_prob = mdl.predict_proba(X)
-        prob.append(curr_prob[0,1])
+def get_predictions(df, df_static,  mdl, iid):
+    # scores every hour of a single stay
+    # all hours are built and scored in one batch - see get_predictions_batch
+    df = df.loc[df['icustay_id']==iid,:]
+    tm = df['hr'].values
+
+    X = get_design_matrix_at_times(df, df_static, np.repeat(iid, tm.shape[0]), tm, W=4, W_extra=24)
+    prob = list(mdl.predict_proba(X)[:,1])
 
     return tm, prob
 
 
 def get_data_at_time(df, df_static, iid, hour=0):
-    df = df.loc[df['icustay_id']==iid,:]
-    tm = df['hr'].values
+    # df can also be an mp_sparse.SparseHourlyData
+    if isinstance(df, mp_sparse.SparseHourlyData):
+        tm = df.get_hours(iid)
+    else:
+        df = df.loc[df['icustay_id']==iid,:]
+        tm = df['hr'].values
     var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early, var_static = vars_of_interest()
 
     idx = [i for i, tval in enumerate(tm) if tval==hour]
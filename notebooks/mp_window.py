@@ -0,0 +1,159 @@
+# Import libraries
+import numpy as np
+
+# helpers shared by the window feature code in mp_utils, mp_index and mp_sparse:
+# the variables the features are extracted for, and the row offsets and window rows
+# of the hourly data sorted by (icustay_id, hr)
+# this module only depends on numpy, so each of those modules can import it
+# they are also available from mp_utils, e.g. mp.vars_of_interest()
+
+# these define 5 lists of variable names
+# these are the variables later used for prediction
+def vars_of_interest():
+    # we extract the min/max for these covariates
+    var_min = ['heartrate', 'sysbp', 'diasbp', 'meanbp',
+                'resprate', 'tempc', 'spo2']
+    var_max = var_min
+    var_min.append('gcs')
+    #var_max.extend(['rrt','vasopressor','vent'])
+
+    # we extract the first/last value for these covariates
+    var_first = ['heartrate', 'sysbp', 'diasbp', 'meanbp',
+                'resprate', 'tempc', 'spo2']
+
+    var_last = var_first
+    var_last.extend(['gcsmotor','gcsverbal','gcseyes','endotrachflag','gcs'])
+
+    var_first_early = ['bg_po2', 'bg_pco2', #'bg_so2'
+            #'bg_fio2_chartevents', 'bg_aado2_calc',
+            #'bg_fio2', 'bg_aado2',
+            'bg_pao2fio2ratio', 'bg_ph', 'bg_baseexcess', #'bg_bicarbonate',
+            'bg_totalco2', #'bg_hematocrit', 'bg_hemoglobin',
+            'bg_carboxyhemoglobin', 'bg_methemoglobin',
+            #'bg_chloride', 'bg_calcium', 'bg_temperature',
+            #'bg_potassium', 'bg_sodium', 'bg_lactate',
+            #'bg_glucose',
+            # 'bg_tidalvolume', 'bg_intubated', 'bg_ventilationrate', 'bg_ventilator',
+            # 'bg_peep', 'bg_o2flow', 'bg_requiredo2',
+            # begin lab values
+            'aniongap', 'albumin', 'bands', 'bicarbonate', 'bilirubin', 'creatinine',
+            'chloride', 'glucose', 'hematocrit', 'hemoglobin', 'lactate', 'platelet',
+            'potassium', 'ptt', 'inr', 'sodium', 'bun', 'wbc']
+
+    var_last_early = var_first_early
+    # fourth set of variables
+    # we have special rules for these...
+    var_sum = ['urineoutput']
+
+    var_static = [u'is_male', u'emergency_admission', u'age',
+               # services
+               u'service_any_noncard_surg',
+               u'service_any_card_surg',
+               u'service_cmed',
+               u'service_traum',
+               u'service_nmed',
+               # ethnicities
+               u'race_black',u'race_hispanic',u'race_asian',u'race_other',
+               # demographics
+               u'height', u'weight', u'bmi']
+
+    return var_min, var_max, var_first, var_last, var_sum, var_first_early, var_last_early, var_static
+
+
+def sort_data(df):
+    # sorts the hourly data by (icustay_id, hr) so each stay is a contiguous block of rows
+    # if the data is already sorted (as it is when loaded in the notebooks) no copy is made
+    iid = df['icustay_id'].values
+    hr = df['hr'].values
+    if iid.shape[0] > 1:
+        d_iid = np.diff(iid)
+        if np.any(d_iid < 0) or np.any((d_iid == 0) & (np.diff(hr) < 0)):
+            df = df.sort_values(['icustay_id','hr'], kind='mergesort')
+    return df
+
+
+def get_stay_offsets(iid):
+    # given a sorted vector of icustay_id, returns the unique icustay_id
+    # and the row offsets for each stay, i.e. stay i is in rows offset[i]:offset[i+1]
+    if iid.shape[0] == 0:
+        return iid, np.zeros(1, dtype=int)
+    idxStart = np.concatenate([[0], np.nonzero(np.diff(iid))[0]+1])
+    offset = np.concatenate([idxStart, [iid.shape[0]]])
+    return iid[idxStart], offset
+
+
+def get_window_key(stay_iid, offset, hr):
+    # combine the stay position and the hour into a single sortable key
+    # as the data is sorted by (icustay_id, hr), this key is sorted too
+    hr_min = np.min(hr) - 1
+    span = np.max(hr) - hr_min + 2
+    stay_pos = np.repeat(np.arange(stay_iid.shape[0]), np.diff(offset))
+    key = stay_pos.astype(np.int64)*span + (hr - hr_min)
+    return key, hr_min, span
+
+
+def get_window_rows(stay_iid, offset, hr, iid, t_start, t_end, key=None):
+    # for each window [t_start, t_end] of the stay iid, finds the rows [a, b) of the
+    # sorted data which fall in the window using one vectorized binary search
+    # key is the output of get_window_key, if it has been computed already
+    iid = np.asarray(iid)
+    t_start = np.asarray(t_start, dtype=int)
+    t_end = np.asarray(t_end, dtype=int)
+    a = np.zeros(iid.shape[0], dtype=int)
+    b = np.zeros(iid.shape[0], dtype=int)
+    if stay_iid.shape[0] == 0 or iid.shape[0] == 0:
+        return a, b
+
+    # locate the stay for each window - windows for unknown stays are left empty
+    pos = np.searchsorted(stay_iid, iid)
+    pos[pos >= stay_iid.shape[0]] = 0
+    found = stay_iid[pos] == iid
+
+    if key is None:
+        key = get_window_key(stay_iid, offset, hr)
+    key, hr_min, span = key
+
+    t_start = np.clip(t_start, hr_min, hr_min+span-1) - hr_min
+    t_end = np.clip(t_end, hr_min, hr_min+span-1) - hr_min
+    a[found] = np.searchsorted(key, pos[found].astype(np.int64)*span + t_start[found], side='left')
+    b[found] = np.searchsorted(key, pos[found].astype(np.int64)*span + t_end[found], side='right')
+    b[b < a] = a[b < a]
+    return a, b
+
+
+def get_window_block(x, a, b):
+    # gathers the rows [a, b) of x for each window into an (N, L) array
+    # L is the longest window, and shorter windows are padded with NaN
+    L = np.max(b - a) if a.shape[0] > 0 else 0
+    L = max(L, 1)
+    idx = a[:,np.newaxis] + np.arange(L)[np.newaxis,:]
+    valid = idx < b[:,np.newaxis]
+    if x.shape[0] == 0:
+        return np.full(idx.shape, np.nan)
+    idx[~valid] = 0
+    block = np.asarray(x, dtype=float)[idx]
+    block[~valid] = np.nan
+    return block
+
+
+def aggregate_window_block(block, agg, notnull=None):
+    # applies an aggregate across each row of the block, ignoring missing values
+    # the aggregates mirror the pandas groupby functions used previously
+    if agg == 'min':
+        return np.fmin.reduce(block, axis=1)
+    elif agg == 'max':
+        return np.fmax.reduce(block, axis=1)
+    elif agg == 'sum':
+        return np.nansum(block, axis=1)
+
+    if notnull is None:
+        notnull = ~np.isnan(block)
+    if agg == 'first':
+        j = np.argmax(notnull, axis=1)
+    elif agg == 'last':
+        j = block.shape[1] - 1 - np.argmax(notnull[:,::-1], axis=1)
+    else:
+        raise ValueError('Unrecognized aggregate: {}'.format(agg))
+
+    # argmax returns the first column if no values are present, which is NaN anyway
+    return block[np.arange(block.shape[0]), j]
@@ -0,0 +1,65 @@
+# tests of the stay and hour selection of mp_refresh, which do not need the database
+# run with: python -m pytest notebooks
+import numpy as np
+import pandas as pd
+import mp_refresh
+
+
+def get_cohort(rows):
+    # rows of [icustay_id, hadm_id, hr_max, hr_last], with hr_last None for new stays
+    return pd.DataFrame(rows, columns=['icustay_id', 'hadm_id', 'hr_max', 'hr_last'])
+
+
+def get_hr_from(df_stays):
+    return dict(zip(df_stays['icustay_id'], df_stays['hr_from']))
+
+
+def test_new_stays_refreshed_in_full():
+    df = get_cohort([[1, 10, 48, None],
+                     [2, 20, 24, 24]])
+    df_stays = mp_refresh.select_refresh_stays(df)
+    assert get_hr_from(df_stays) == {1: -np.inf}
+
+
+def test_extended_stays_refreshed_from_last_hour():
+    # the last hour already built may have been partly observed, so it is refreshed as well
+    df = get_cohort([[1, 10, 30, 24],
+                     [2, 20, 24, 24]])
+    df_stays = mp_refresh.select_refresh_stays(df)
+    assert get_hr_from(df_stays) == {1: 24}
+
+
+def test_stays_with_new_data():
+    # the earlier of the hour given and the last hour built is used, and
+    # stays not in the cohort are ignored
+    df = get_cohort([[1, 10, 48, 48],
+                     [2, 20, 30, 24],
+                     [3, 30, 30, 24]])
+    df_stays = mp_refresh.select_refresh_stays(df, stays={1: 12, 2: 26, 3: 5, 99: 0})
+    assert get_hr_from(df_stays) == {1: 12, 2: 24, 3: 5}
+
+
+def test_admissions_with_many_stays_refreshed_in_full():
+    # the lab and blood gas pivots are keyed on hadm_id, so every stay of the admission is rebuilt
+    df = get_cohort([[1, 10, 48, 48],
+                     [2, 10, 48, 40],
+                     [3, 30, 24, 24]])
+    df_stays = mp_refresh.select_refresh_stays(df)
+    assert get_hr_from(df_stays) == {1: -np.inf, 2: -np.inf}
+
+
+def test_sorted_by_admission():
+    df = get_cohort([[5, 10, 24, None],
+                     [2, 30, 24, None],
+                     [4, 20, 24, None],
+                     [3, 20, 24, None]])
+    df_stays = mp_refresh.select_refresh_stays(df)
+    assert list(df_stays.columns) == ['icustay_id', 'hadm_id', 'hr_from']
+    assert df_stays['icustay_id'].tolist() == [5, 3, 4, 2]
+    assert df_stays.index.tolist() == [0, 1, 2, 3]
+
+
+def test_nothing_to_refresh():
+    df = get_cohort([[1, 10, 24, 24]])
+    df_stays = mp_refresh.select_refresh_stays(df, stays={})
+    assert df_stays.shape[0] == 0